@@ -9,54 +9,27 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from mtapi.mtapi import Mtapi
-from flask import Flask, request, Response, render_template, abort, redirect
+from mtapi.mtapi import Mtapi, render_envelope, render_batch, _json_default
+from mtapi._mtapienvelope import choose_encoding, snapshot_etag
+from mtapi._mtapiarchive import parse_time
+from mtapi._mtapiconfig import load_config, mtapi_options
+from mtapi._spatialindex import parse_location
+from flask import Flask, request, Response, render_template, abort, redirect, stream_with_context
 import json
-from datetime import datetime
 from functools import wraps, reduce
 import logging
-import os
+import math
+import time
 
 app = Flask(__name__)
-app.config.update(
-    MAX_TRAINS=10,
-    MAX_MINUTES=30,
-    CACHE_SECONDS=60,
-    THREADED=True
-)
-
-_SETTINGS_ENV_VAR = 'MTAPI_SETTINGS'
-_SETTINGS_DEFAULT_PATH = './settings.cfg'
-if _SETTINGS_ENV_VAR in os.environ:
-    app.config.from_envvar(_SETTINGS_ENV_VAR)
-elif os.path.isfile(_SETTINGS_DEFAULT_PATH):
-    app.config.from_pyfile(_SETTINGS_DEFAULT_PATH)
-else:
-    raise Exception('No configuration found! Create a settings.cfg file or set MTAPI_SETTINGS env variable.')
+app.config.update(load_config())
 
 # set debug logging
 if app.debug:
     logging.basicConfig(level=logging.INFO,
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        try:
-            if isinstance(obj, datetime):
-                return obj.isoformat()
-            iterable = iter(obj)
-        except TypeError:
-            pass
-        else:
-            return list(iterable)
-        return JSONEncoder.default(self, obj)
-
-mta = Mtapi(
-    app.config['STATIONS_FILE'],
-    max_trains=app.config['MAX_TRAINS'],
-    max_minutes=app.config['MAX_MINUTES'],
-    expires_seconds=app.config['CACHE_SECONDS'],
-    threaded=app.config['THREADED'])
+mta = Mtapi(app.config['STATIONS_FILE'], shared_role='reader', **mtapi_options(app.config))
 
 def response_wrapper(f):
     @wraps(f)
@@ -64,9 +37,9 @@ def response_wrapper(f):
         resp = f(*args, **kwargs)
 
         if not isinstance(resp, Response):
-            # custom JSON encoder; this is important
+            # _json_default encodes the datetimes and sets in responses
             resp = Response(
-                response=json.dumps(resp, cls=CustomJSONEncoder),
+                response=json.dumps(resp, default=_json_default),
                 status=200,
                 mimetype="application/json"
             )
@@ -77,6 +50,32 @@ def response_wrapper(f):
 
     return decorated_function
 
+def snapshot_cached(f):
+    '''For endpoints whose output depends only on the current snapshot: tag
+    responses with the snapshot version and answer If-None-Match with a 304
+    before doing any work.'''
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # tag the snapshot before building the body so a racing update can
+        # only make the tag older than the body, never newer
+        etag = snapshot_etag(mta.snapshot(), choose_encoding(request.headers.get('Accept-Encoding')))
+        max_age = mta.seconds_until_update()
+
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            resp = f(*args, **kwargs)
+            if resp.status_code != 200:
+                return resp
+
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = math.ceil(max_age) if max_age is not None else 0
+
+        return resp
+
+    return decorated_function
+
 def add_cors_header(resp):
     if app.config['DEBUG']:
         resp.headers['Access-Control-Allow-Origin'] = '*'
@@ -85,6 +84,18 @@ def add_cors_header(resp):
 
     return resp
 
+@app.before_request
+def start_timer():
+    request.started = time.perf_counter()
+
+@app.after_request
+def record_latency(resp):
+    if request.endpoint and hasattr(request, 'started'):
+        mta.metrics.observe('mtapi_request_seconds', time.perf_counter() - request.started,
+                            endpoint=request.endpoint)
+
+    return resp
+
 @app.route('/')
 @response_wrapper
 def index():
@@ -95,10 +106,12 @@ def index():
 
 @app.route('/by-location', methods=['GET'])
 @response_wrapper
+@snapshot_cached
 def by_location():
     try:
-        location = (float(request.args['lat']), float(request.args['lon']))
-    except KeyError as e:
+        location, radius = parse_location(request.args['lat'], request.args['lon'],
+                                          request.args.get('radius'))
+    except (KeyError, ValueError) as e:
         print(e)
         resp = Response(
             response=json.dumps({'error': 'Missing lat/lon parameter'}),
@@ -108,19 +121,18 @@ def by_location():
 
         return add_cors_header(resp)
 
-    data = mta.get_by_point(location, 5)
-    return _make_envelope(data)
+    return _envelope_response(mta.get_envelope_by_point(location, 5, radius, **_limit_args()))
 
 @app.route('/by-route/<route>', methods=['GET'])
 @response_wrapper
+@snapshot_cached
 def by_route(route):
 
     if route.islower():
         return redirect(request.host_url + 'by-route/' + route.upper(), code=301)
 
     try:
-        data = mta.get_by_route(route)
-        return _make_envelope(data)
+        return _envelope_response(mta.get_envelope_by_route(route, **_limit_args()))
     except KeyError as e:
         resp = Response(
             response=json.dumps({'error': 'Station not found'}),
@@ -132,11 +144,11 @@ def by_route(route):
 
 @app.route('/by-id/<id_string>', methods=['GET'])
 @response_wrapper
+@snapshot_cached
 def by_index(id_string):
     ids = id_string.split(',')
     try:
-        data = mta.get_by_id(ids)
-        return _make_envelope(data)
+        return _envelope_response(mta.get_envelope_by_id(ids, **_limit_args()))
     except KeyError as e:
         resp = Response(
             response=json.dumps({'error': 'Station not found'}),
@@ -146,14 +158,142 @@ def by_index(id_string):
 
         return add_cors_header(resp)
 
+@app.route('/by-trip/<id_string>', methods=['GET'])
+@response_wrapper
+@snapshot_cached
+def by_trip(id_string):
+    ids = id_string.split(',')
+    try:
+        return _envelope_response(mta.get_envelope_by_trip(ids))
+    except KeyError as e:
+        return _json_error('Trip not found', 404)
+
+@app.route('/by-trip/<id_string>/position', methods=['GET'])
+@response_wrapper
+def trip_position(id_string):
+    ids = id_string.split(',')
+    try:
+        return _make_envelope(mta.get_trip_positions(ids))
+    except KeyError as e:
+        return _json_error('Trip not found', 404)
+
+@app.route('/history/by-id/<id_string>', methods=['GET'])
+@response_wrapper
+def history_by_id(id_string):
+    return _history(lambda at: mta.get_history_by_id(id_string.split(','), at), 'Station not found')
+
+@app.route('/history/by-route/<route>', methods=['GET'])
+@response_wrapper
+def history_by_route(route):
+    return _history(lambda at: mta.get_history_by_route(route, at), 'Route not found')
+
+def _history(query, not_found):
+    if mta.archive is None:
+        return _json_error('No archive configured', 404)
+
+    try:
+        at = parse_time(request.args['at'])
+    except (KeyError, ValueError):
+        return _json_error('Missing or invalid at parameter', 400)
+
+    try:
+        return _make_envelope(query(at))
+    except KeyError:
+        return _json_error(not_found, 404)
+
+@app.route('/stream', methods=['GET'])
+def stream():
+    ids = [ id for id in request.args.get('ids', '').split(',') if id ]
+    routes = [ route for route in request.args.get('routes', '').split(',') if route ]
+
+    try:
+        subscription = mta.subscribe(ids, routes)
+    except KeyError as e:
+        resp = Response(
+            response=json.dumps({'error': 'Station not found'}),
+            status=404,
+            mimetype="application/json"
+        )
+
+        return add_cors_header(resp)
+
+    def events():
+        try:
+            # the first event is the full state, later ones only what changed
+            changed = None
+            idle = 0
+            while True:
+                if changed is None or changed:
+                    body, _ = render_envelope(mta.get_json_by_subscription(subscription, changed),
+                                              app.config['COMPACT_JSON'])
+                    yield b'data: ' + body + b'\n\n'
+                    idle = 0
+                elif idle >= app.config['STREAM_KEEPALIVE']:
+                    yield b': keepalive\n\n'
+                    idle = 0
+
+                poll = min(app.config['STREAM_POLL_SECONDS'], app.config['STREAM_KEEPALIVE'])
+                changed = subscription.wait(poll)
+                idle += poll
+                if not changed and not subscription.closed:
+                    # a worker whose only clients are streams gets no other
+                    # queries to pick up new snapshots
+                    mta.version()
+                    changed = subscription.wait(0)
+        finally:
+            subscription.close()
+
+    resp = Response(stream_with_context(events()), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+
+    return add_cors_header(resp)
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list):
+        return _json_error('Expected a JSON body with a list of queries', 400)
+    elif len(queries) > app.config['MAX_BATCH_QUERIES']:
+        return _json_error('At most %d queries per batch' % app.config['MAX_BATCH_QUERIES'], 400)
+
+    try:
+        results = mta.get_json_batch(queries)
+    except ValueError as e:
+        return _json_error(str(e), 400)
+
+    resp = Response(response=render_batch(results, app.config['COMPACT_JSON']), status=200,
+                    mimetype="application/json")
+    return add_cors_header(resp)
+
+def _json_error(message, status):
+    resp = Response(
+        response=json.dumps({'error': message}),
+        status=status,
+        mimetype="application/json"
+    )
+
+    return add_cors_header(resp)
+
 @app.route('/routes', methods=['GET'])
 @response_wrapper
 def routes():
+    snapshot = mta.snapshot()
     return {
-        'data': sorted(mta.get_routes()),
-        'updated': mta.last_update()
+        'data': sorted(snapshot.routes),
+        'updated': snapshot.last_update
         }
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(mta.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def _limit_args():
+    return {
+        'max_trains': request.args.get('max_trains', type=int),
+        'max_minutes': request.args.get('max_minutes', type=int)
+    }
+
 def _envelope_reduce(a, b):
     if a['last_update'] and b['last_update']:
         return a if a['last_update'] < b['last_update'] else b
@@ -172,5 +312,17 @@ def _make_envelope(data):
         'updated': time
     }
 
+def _envelope_response(envelope):
+    '''Send a pre-rendered envelope, compressed if the client accepts it.'''
+    body, encoding = envelope.encode(choose_encoding(request.headers.get('Accept-Encoding')))
+
+    resp = Response(response=body, status=200, mimetype="application/json")
+    resp.last_modified = envelope.updated
+    resp.vary.add('Accept-Encoding')
+    if encoding:
+        resp.content_encoding = encoding
+
+    return resp
+
 if __name__ == '__main__':
     app.run(use_reloader=False)
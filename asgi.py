@@ -0,0 +1,347 @@
+# coding: utf-8
+"""
+    mta-api-sanity asgi
+    ~~~~~~
+
+    Asyncio serving mode. Serves the same endpoints as app.py from one event
+    loop, refreshing feeds in the background without blocking requests. Run it
+    under any ASGI server, e.g. `uvicorn asgi:app`.
+
+    :copyright: (c) 2014 by Jon Thornton.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from mtapi.mtapi import Mtapi, render_envelope, render_batch, _json_default
+from mtapi._mtapienvelope import choose_encoding, snapshot_etag
+from mtapi._mtapiarchive import parse_time
+from mtapi._mtapiconfig import load_config, mtapi_options
+from mtapi._spatialindex import parse_location
+from email.utils import format_datetime
+from urllib.parse import parse_qs
+import asyncio
+import datetime
+import json
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+config = load_config()
+
+if config['DEBUG']:
+    logging.basicConfig(level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+# the event loop drives updates, so Mtapi never refreshes inside a request
+mta = Mtapi(config['STATIONS_FILE'], shared_role='reader', autoupdate=False, **mtapi_options(config))
+
+_refresh_task = None
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'http':
+        _start_refreshing()
+        started = time.perf_counter()
+        endpoint = await _dispatch(scope, receive, send)
+        mta.metrics.observe('mtapi_request_seconds', time.perf_counter() - started, endpoint=endpoint)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # a restored snapshot can be served while the first refresh runs
+            if not mta.restored:
+                await mta.update_async()
+            _start_refreshing()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _refresh_task:
+                _refresh_task.cancel()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+def _start_refreshing():
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.ensure_future(_refresh_forever())
+
+async def _refresh_forever():
+    while True:
+        try:
+            await mta.update_async()
+        except Exception:
+            logger.exception('Update failed')
+
+        # wake when the next feed is due, but at least every CACHE_SECONDS
+        next_refresh = mta.next_refresh()
+        delay = next_refresh - time.time() if next_refresh is not None else config['CACHE_SECONDS']
+        await asyncio.sleep(min(max(delay, 1), config['CACHE_SECONDS']))
+
+async def _dispatch(scope, receive, send):
+    '''Route a request and return the name of the endpoint that served it,
+    matching the Flask endpoint names in app.py.'''
+    path = scope['path']
+    query = parse_qs(scope.get('query_string', b'').decode())
+
+    if path == '/':
+        await _send_json(send, 200, {
+            'title': 'MTAPI',
+            'readme': 'Visit https://github.com/jonthornton/MTAPI for more info'
+            })
+        return 'index'
+    elif path == '/by-location':
+        await by_location(scope, send, query)
+        return 'by_location'
+    elif path.startswith('/by-route/'):
+        await by_route(scope, send, query, path[len('/by-route/'):])
+        return 'by_route'
+    elif path.startswith('/by-id/'):
+        await by_id(scope, send, query, path[len('/by-id/'):])
+        return 'by_index'
+    elif path.startswith('/by-trip/') and path.endswith('/position'):
+        await trip_position(send, path[len('/by-trip/'):-len('/position')])
+        return 'trip_position'
+    elif path.startswith('/by-trip/'):
+        ids = path[len('/by-trip/'):].split(',')
+        await _send_cached(scope, send, lambda: mta.get_envelope_by_trip(ids), 'Trip not found')
+        return 'by_trip'
+    elif path.startswith('/history/by-id/'):
+        ids = path[len('/history/by-id/'):].split(',')
+        await history(send, query, lambda at: mta.get_history_by_id(ids, at), 'Station not found')
+        return 'history_by_id'
+    elif path.startswith('/history/by-route/'):
+        route = path[len('/history/by-route/'):]
+        await history(send, query, lambda at: mta.get_history_by_route(route, at), 'Route not found')
+        return 'history_by_route'
+    elif path == '/routes':
+        snapshot = mta.snapshot()
+        await _send_json(send, 200, {
+            'data': sorted(snapshot.routes),
+            'updated': snapshot.last_update
+            })
+        return 'routes'
+    elif path == '/stream':
+        await stream(scope, receive, send, query)
+        return 'stream'
+    elif path == '/batch' and scope.get('method') == 'POST':
+        await batch(receive, send)
+        return 'batch'
+    elif path == '/metrics':
+        await _send(send, 200, mta.render_metrics().encode(), content_type=b'text/plain; version=0.0.4')
+        return 'metrics'
+
+    await _send_json(send, 404, {'error': 'Not found'})
+    return None
+
+async def by_location(scope, send, query):
+    try:
+        location, radius = parse_location(query['lat'][0], query['lon'][0],
+                                          query['radius'][0] if 'radius' in query else None)
+    except (KeyError, ValueError):
+        await _send_json(send, 400, {'error': 'Missing lat/lon parameter'})
+        return
+
+    limits = _limit_args(query)
+    await _send_cached(scope, send, lambda: mta.get_envelope_by_point(location, 5, radius, **limits))
+
+async def by_route(scope, send, query, route):
+    if route.islower():
+        await _send(send, 301, b'', [(b'location', ('/by-route/' + route.upper()).encode())])
+        return
+
+    limits = _limit_args(query)
+    await _send_cached(scope, send, lambda: mta.get_envelope_by_route(route, **limits))
+
+async def by_id(scope, send, query, id_string):
+    ids = id_string.split(',')
+    limits = _limit_args(query)
+    await _send_cached(scope, send, lambda: mta.get_envelope_by_id(ids, **limits))
+
+async def trip_position(send, id_string):
+    try:
+        positions = mta.get_trip_positions(id_string.split(','))
+    except KeyError:
+        await _send_json(send, 404, {'error': 'Trip not found'})
+        return
+
+    times = [ position['last_update'] for position in positions if position['last_update'] ]
+    await _send_json(send, 200, {'data': positions, 'updated': min(times) if times else None})
+
+async def history(send, query, get_stations, not_found):
+    if mta.archive is None:
+        await _send_json(send, 404, {'error': 'No archive configured'})
+        return
+
+    try:
+        at = parse_time(query['at'][0])
+    except (KeyError, ValueError):
+        await _send_json(send, 400, {'error': 'Missing or invalid at parameter'})
+        return
+
+    try:
+        # reading the archive decompresses segments; keep it off the loop
+        stations = await asyncio.get_running_loop().run_in_executor(None, get_stations, at)
+    except KeyError:
+        await _send_json(send, 404, {'error': not_found})
+        return
+
+    times = [ station['last_update'] for station in stations if station['last_update'] ]
+    await _send_json(send, 200, {'data': stations, 'updated': min(times) if times else None})
+
+async def batch(receive, send):
+    try:
+        body = json.loads(await _read_body(receive))
+    except ValueError:
+        body = None
+
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list):
+        await _send_json(send, 400, {'error': 'Expected a JSON body with a list of queries'})
+        return
+    elif len(queries) > config['MAX_BATCH_QUERIES']:
+        await _send_json(send, 400, {'error': 'At most %d queries per batch' % config['MAX_BATCH_QUERIES']})
+        return
+
+    try:
+        results = mta.get_json_batch(queries)
+    except ValueError as e:
+        await _send_json(send, 400, {'error': str(e)})
+        return
+
+    await _send(send, 200, render_batch(results, config['COMPACT_JSON']))
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+def _limit_args(query):
+    limits = {}
+    for name in ('max_trains', 'max_minutes'):
+        try:
+            limits[name] = int(query[name][0])
+        except (KeyError, ValueError):
+            limits[name] = None
+
+    return limits
+
+async def stream(scope, receive, send, query):
+    ids = [ id for id in ','.join(query.get('ids', [])).split(',') if id ]
+    routes = [ route for route in ','.join(query.get('routes', [])).split(',') if route ]
+
+    loop = asyncio.get_running_loop()
+    changed_event = asyncio.Event()
+
+    try:
+        subscription = mta.subscribe(ids, routes,
+                                     on_change=lambda: loop.call_soon_threadsafe(changed_event.set))
+    except KeyError:
+        await _send_json(send, 404, {'error': 'Station not found'})
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')] + _cors_headers()
+    })
+
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        # the first event is the full state, later ones only what changed
+        changed = None
+        while not disconnected.done():
+            if changed is None or changed:
+                body, _ = render_envelope(mta.get_json_by_subscription(subscription, changed),
+                                          config['COMPACT_JSON'])
+                chunk = b'data: ' + body + b'\n\n'
+            else:
+                chunk = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+            waiting = asyncio.ensure_future(changed_event.wait())
+            await asyncio.wait([waiting, disconnected], timeout=config['STREAM_KEEPALIVE'],
+                               return_when=asyncio.FIRST_COMPLETED)
+            waiting.cancel()
+            changed_event.clear()
+            changed = subscription.wait(0)
+    finally:
+        subscription.close()
+        disconnected.cancel()
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _send_cached(scope, send, get_envelope, not_found='Station not found'):
+    '''Send a pre-rendered envelope with the same validators as
+    app.snapshot_cached, answering If-None-Match with a 304 and compressing
+    the body if the client accepts it.'''
+    encoding = choose_encoding(_header(scope, b'accept-encoding'))
+    etag = '"%s"' % snapshot_etag(mta.snapshot(), encoding)
+    max_age = mta.seconds_until_update()
+    headers = [
+        (b'etag', etag.encode()),
+        (b'cache-control', b'public, max-age=%d' % (math.ceil(max_age) if max_age is not None else 0)),
+        (b'vary', b'Accept-Encoding')
+    ]
+
+    if etag in _if_none_match(scope):
+        await _send(send, 304, b'', headers)
+        return
+
+    try:
+        envelope = get_envelope()
+    except KeyError:
+        await _send_json(send, 404, {'error': not_found})
+        return
+
+    body, encoding = envelope.encode(encoding)
+    if encoding:
+        headers.append((b'content-encoding', encoding.encode()))
+    if envelope.updated:
+        last_modified = format_datetime(envelope.updated.astimezone(datetime.timezone.utc), usegmt=True)
+        headers.append((b'last-modified', last_modified.encode()))
+
+    await _send(send, 200, body, headers)
+
+def _if_none_match(scope):
+    value = _header(scope, b'if-none-match')
+    if value is None:
+        return []
+
+    return [ tag.strip() for tag in value.split(',') ]
+
+def _header(scope, name):
+    for header, value in scope['headers']:
+        if header == name:
+            return value.decode('latin-1')
+
+    return None
+
+def _cors_headers():
+    if config['DEBUG']:
+        return [(b'access-control-allow-origin', b'*')]
+    elif 'CROSS_ORIGIN' in config:
+        return [(b'access-control-allow-origin', config['CROSS_ORIGIN'].encode())]
+
+    return []
+
+async def _send_json(send, status, data):
+    await _send(send, status, json.dumps(data, default=_json_default).encode())
+
+async def _send(send, status, body, headers=(), content_type=b'application/json'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type),
+            (b'content-length', str(len(body)).encode())
+        ] + _cors_headers() + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,166 @@
+# Benchmarks for the ingest and query paths. Feeds are replayed from disk
+# (scripts/record_feeds.py) or generated, so runs are reproducible offline.
+#
+#   $ python -m benchmarks.bench                       # synthetic feeds at 1x, 5x and 10x
+#   $ python -m benchmarks.bench --fixtures feeds/     # recorded feeds
+#   $ python -m benchmarks.bench --save baseline.json
+#   $ python -m benchmarks.bench --compare baseline.json   # exits 1 on a regression
+
+import argparse, gc, json, random, statistics, sys, time, tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.fixtures import ReplayMtapi, synthetic_feeds, recorded_feeds, bump_timestamp
+
+
+def bench_update(feeds, repeat):
+    '''Time Mtapi._update end to end with every feed changed, and measure the
+    memory it allocates and retains.'''
+    mta = ReplayMtapi(dict(feeds), expires_seconds=0, autoupdate=False)
+    timings = []
+
+    for i in range(repeat):
+        for url in feeds:
+            mta.feed_data[url] = bump_timestamp(feeds[url], i + 1)
+
+        started = time.perf_counter()
+        mta._update()
+        timings.append(time.perf_counter() - started)
+
+    for url in feeds:
+        mta.feed_data[url] = bump_timestamp(feeds[url], repeat + 1)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    mta._update()
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    return mta, {
+        'update_ms': statistics.median(timings) * 1000,
+        'update_peak_kb': peak / 1024,
+        'update_retained_kb': sum(stat.size_diff for stat in stats) / 1024,
+        'update_allocations': sum(max(0, stat.count_diff) for stat in stats)
+    }
+
+def query_workload(mta, seed=0):
+    '''Named callables exercising each query path with random arguments.'''
+    rng = random.Random(seed)
+    snapshot = mta._snapshot
+    station_ids = sorted(snapshot.stations)
+    routes = sorted(snapshot.route_stations) or [None]
+
+    def point():
+        return (rng.uniform(40.55, 40.9), rng.uniform(-74.05, -73.75))
+
+    def ids():
+        return rng.sample(station_ids, 3)
+
+    return {
+        'by_point': lambda: mta.get_by_point(point(), 5),
+        'by_route': lambda: mta.get_by_route(rng.choice(routes)),
+        'by_id': lambda: mta.get_by_id(ids()),
+        # what app.py and asgi.py serve: the cached envelope, gzipped
+        'envelope_by_point': lambda: mta.get_envelope_by_point(point(), 5).encode('gzip'),
+        'envelope_by_route': lambda: mta.get_envelope_by_route(rng.choice(routes)).encode('gzip'),
+        'envelope_by_id': lambda: mta.get_envelope_by_id(ids()).encode('gzip')
+    }
+
+def bench_queries(mta, count, threads):
+    results = {}
+
+    for name, query in query_workload(mta).items():
+        timings = []
+        for _ in range(count):
+            started = time.perf_counter()
+            query()
+            timings.append(time.perf_counter() - started)
+
+        timings.sort()
+        results[name + '_us'] = statistics.median(timings) * 1e6
+        results[name + '_p99_us'] = timings[int(len(timings) * 0.99) - 1] * 1e6
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            started = time.perf_counter()
+            for future in [ pool.submit(query) for _ in range(count) ]:
+                future.result()
+            results[name + '_per_s'] = count / (time.perf_counter() - started)
+
+    return results
+
+def run(feeds_for_scale, scales, repeat, count, threads):
+    results = {}
+    for scale in scales:
+        feeds = feeds_for_scale(scale)
+        size = sum(len(data) for data in feeds.values())
+        print('scale %sx: %d feeds, %d KB' % (scale, len(feeds), size // 1024), file=sys.stderr)
+
+        mta, update = bench_update(feeds, repeat)
+        results['scale=%s' % scale] = dict(update, **bench_queries(mta, count, threads))
+
+    return results
+
+def compare(results, baseline, tolerance):
+    '''Return (metric, baseline, current) for every metric that got worse by
+    more than tolerance. Throughput metrics (_per_s) regress downward.'''
+    regressions = []
+    for scale, metrics in baseline.items():
+        for name, old in metrics.items():
+            new = results.get(scale, {}).get(name)
+            if new is None or not old:
+                continue
+
+            if name.endswith('_per_s'):
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance)
+
+            if worse:
+                regressions.append(('%s %s' % (scale, name), old, new))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MTAPI ingest and queries against replayed feeds.')
+    parser.add_argument('--fixtures', help='directory of feeds saved by scripts/record_feeds.py')
+    parser.add_argument('--scale', type=float, nargs='+', default=[1, 5, 10],
+                        help='trip count multipliers; 5-10 approximates a heavy rush hour')
+    parser.add_argument('--repeat', type=int, default=5, help='timed refreshes per scale')
+    parser.add_argument('--queries', type=int, default=2000, help='queries per query type')
+    parser.add_argument('--threads', type=int, default=8, help='threads for the throughput runs')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before failing --compare')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        feeds_for_scale = lambda scale: recorded_feeds(args.fixtures, scale=scale)
+    else:
+        feeds_for_scale = lambda scale: synthetic_feeds(scale=scale)
+
+    results = run(feeds_for_scale, args.scale, args.repeat, args.queries, args.threads)
+
+    for scale, metrics in results.items():
+        print(scale)
+        for name, value in metrics.items():
+            print('    %-28s %12.1f' % (name, value))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for name, old, new in regressions:
+            print('REGRESSION %s: %.1f -> %.1f' % (name, old, new))
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Feed fixtures for tests and benchmarks: synthetic GTFS-realtime feeds, replay of
+# feeds recorded with scripts/record_feeds.py, and an Mtapi that reads from them.
+
+import json, os, random, time
+from collections import defaultdict
+from mtapi import Mtapi
+from mtaproto import nyct_subway_pb2
+
+STATIONS_FILE = './data/stations.json'
+
+# routes and stop id prefixes carried by each of Mtapi._FEED_URLS
+FEED_ROUTES = [
+    (['1', '2', '3', '4', '5', '6', '6X', '7', '7X', 'GS'], '12345679'),
+    (['L'], 'L'),
+    (['N', 'Q', 'R', 'W'], 'NQR'),
+    (['B', 'D', 'F', 'M'], 'BDF'),
+    (['A', 'C', 'E', 'H'], 'AEH'),
+    (['SI'], 'S'),
+    (['J', 'Z'], 'JM'),
+    (['G'], 'G')
+]
+
+# roughly the number of trips per route in a midday feed
+TRIPS_PER_ROUTE = 20
+STOPS_PER_TRIP = 25
+
+
+def make_feed(trips, timestamp=None):
+    '''Build a serialized NYCT FeedMessage. trips is a list of
+    (trip_id, route_id, direction, [(stop_id, epoch), ...]) tuples.'''
+    feed = nyct_subway_pb2.gtfs__realtime__pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '1.0'
+    feed.header.timestamp = int(timestamp or time.time())
+
+    for trip_id, route_id, direction, stops in trips:
+        entity = feed.entity.add()
+        entity.id = trip_id
+        entity.trip_update.trip.trip_id = trip_id
+        entity.trip_update.trip.route_id = route_id
+        nyct_trip = entity.trip_update.trip.Extensions[nyct_subway_pb2.nyct_trip_descriptor]
+        nyct_trip.direction = nyct_subway_pb2.NyctTripDescriptor.Direction.Value(direction)
+
+        for stop_id, epoch in stops:
+            update = entity.trip_update.stop_time_update.add()
+            update.stop_id = stop_id
+            update.arrival.time = int(epoch)
+
+    return feed.SerializeToString()
+
+def synthetic_feeds(now=None, scale=1.0, seed=0, stations_file=STATIONS_FILE):
+    '''Build one feed per Mtapi._FEED_URLS entry with TRIPS_PER_ROUTE * scale
+    trips per route. A scale of 5-10 approximates a heavy rush hour.'''
+    now = int(now or time.time())
+    rng = random.Random(seed)
+
+    with open(stations_file) as f:
+        stations = json.load(f)
+
+    stops_by_prefix = defaultdict(list)
+    for station in stations.values():
+        for stop_id in station['stops']:
+            stops_by_prefix[stop_id[0]].append(stop_id)
+
+    feeds = {}
+    for url, (routes, prefixes) in zip(Mtapi._FEED_URLS, FEED_ROUTES):
+        line = sorted(stop_id for prefix in prefixes for stop_id in stops_by_prefix[prefix])
+        trips = []
+
+        for route_id in routes:
+            for i in range(int(TRIPS_PER_ROUTE * scale)):
+                direction = rng.choice(['NORTH', 'SOUTH'])
+                start = rng.randrange(len(line))
+                stops = line[start:start + STOPS_PER_TRIP]
+                if direction == 'SOUTH':
+                    stops.reverse()
+
+                epoch = now + rng.randint(-300, 1800)
+                trip_stops = []
+                for stop_id in stops:
+                    trip_stops.append((stop_id + direction[0], epoch))
+                    epoch += rng.randint(60, 180)
+
+                trips.append(('%s-%s-%d' % (url[-4:], route_id, i), route_id, direction, trip_stops))
+
+        feeds[url] = make_feed(trips, now)
+
+    return feeds
+
+def recorded_feed_name(url):
+    return url.rsplit('%2F', 1)[-1] + '.pb'
+
+def recorded_feeds(directory, now=None, scale=1):
+    '''Load feeds saved by scripts/record_feeds.py. Times are shifted so the
+    recording's header timestamp becomes now, and with scale > 1 every trip is
+    repeated with a small offset.'''
+    now = int(now or time.time())
+    feeds = {}
+
+    for url in Mtapi._FEED_URLS:
+        path = os.path.join(directory, recorded_feed_name(url))
+        if not os.path.isfile(path):
+            continue
+
+        with open(path, 'rb') as f:
+            feeds[url] = shift_feed(f.read(), now, scale)
+
+    return feeds
+
+def shift_feed(data, now, scale=1):
+    feed = nyct_subway_pb2.gtfs__realtime__pb2.FeedMessage()
+    feed.ParseFromString(data)
+    delta = now - feed.header.timestamp
+    feed.header.timestamp = now
+
+    originals = [ entity for entity in feed.entity if entity.HasField('trip_update') ]
+    for copy in range(1, int(scale)):
+        for original in originals:
+            entity = feed.entity.add()
+            entity.CopyFrom(original)
+            entity.id += '-%d' % copy
+            entity.trip_update.trip.trip_id += '-%d' % copy
+            for update in entity.trip_update.stop_time_update:
+                if update.HasField('arrival'):
+                    update.arrival.time += copy * 20
+                if update.HasField('departure'):
+                    update.departure.time += copy * 20
+
+    for entity in feed.entity:
+        for update in entity.trip_update.stop_time_update:
+            if update.HasField('arrival'):
+                update.arrival.time += delta
+            if update.HasField('departure'):
+                update.departure.time += delta
+
+    return feed.SerializeToString()
+
+def bump_timestamp(data, seconds=1):
+    '''Return data with its header timestamp moved, so Mtapi re-ingests it.'''
+    feed = nyct_subway_pb2.gtfs__realtime__pb2.FeedMessage()
+    feed.ParseFromString(data)
+    feed.header.timestamp += seconds
+
+    return feed.SerializeToString()
+
+
+class ReplayMtapi(Mtapi):
+    '''Mtapi that reads feeds from a dict of url -> bytes (or callables
+    returning bytes) instead of the MTA servers.'''
+
+    def __init__(self, feeds, *args, stations_file=STATIONS_FILE, **kwargs):
+        self.feed_data = feeds
+        super().__init__(stations_file, *args, **kwargs)
+
+    def _load_mta_feed(self, feed):
+        data = self.feed_data.get(feed.url)
+        if callable(data):
+            data = data()
+
+        return data or False
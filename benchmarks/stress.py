@@ -0,0 +1,83 @@
+# Read throughput under continuous refreshes. Reader threads run the query
+# workload from bench.py against one Mtapi while another thread re-ingests
+# every feed as fast as it can, so each read races a snapshot swap.
+#
+#   $ python -m benchmarks.stress                          # 1, 2, 4 and 8 readers
+#   $ python -m benchmarks.stress --threads 1 16 --seconds 10 --fixtures feeds/
+
+import argparse, statistics, sys, threading, time
+from benchmarks.bench import query_workload
+from benchmarks.fixtures import ReplayMtapi, synthetic_feeds, recorded_feeds, bump_timestamp
+
+
+def stress(feeds, threads, seconds):
+    '''Run threads readers for seconds while refreshing continuously. Returns
+    read throughput and latency, and how many snapshots were published.'''
+    mta = ReplayMtapi(dict(feeds), expires_seconds=0, autoupdate=False)
+    mta._update()
+
+    # alternate between two timestamps so every refresh re-ingests every feed
+    variants = [ { url: bump_timestamp(data, i) for url, data in feeds.items() } for i in (1, 2) ]
+    stop = threading.Event()
+    versions = []
+    timings = [ [] for _ in range(threads) ]
+
+    def refresh():
+        i = 0
+        while not stop.is_set():
+            mta.feed_data.update(variants[i % 2])
+            mta._update()
+            versions.append(mta.version())
+            i += 1
+
+    def read(n):
+        queries = list(query_workload(mta, seed=n).values())
+        out = timings[n]
+        i = 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            queries[i % len(queries)]()
+            out.append(time.perf_counter() - started)
+            i += 1
+
+    workers = [ threading.Thread(target=refresh) ] + \
+              [ threading.Thread(target=read, args=(n,)) for n in range(threads) ]
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    latencies = sorted(t for thread_timings in timings for t in thread_timings)
+    return {
+        'reads_per_s': len(latencies) / seconds,
+        'read_median_us': statistics.median(latencies) * 1e6,
+        'read_p99_us': latencies[int(len(latencies) * 0.99) - 1] * 1e6,
+        'read_max_us': latencies[-1] * 1e6,
+        'snapshots': len(set(versions))
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure MTAPI read throughput during continuous refreshes.')
+    parser.add_argument('--fixtures', help='directory of feeds saved by scripts/record_feeds.py')
+    parser.add_argument('--scale', type=float, default=1, help='trip count multiplier')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='reader thread counts')
+    parser.add_argument('--seconds', type=float, default=3, help='duration of each run')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        feeds = recorded_feeds(args.fixtures, scale=args.scale)
+    else:
+        feeds = synthetic_feeds(scale=args.scale)
+
+    print('%8s %12s %12s %12s %12s %10s' % ('readers', 'reads/s', 'median us', 'p99 us', 'max us', 'snapshots'))
+    for threads in args.threads:
+        result = stress(feeds, threads, args.seconds)
+        print('%8d %12.0f %12.1f %12.1f %12.1f %10d' % (threads, result['reads_per_s'], result['read_median_us'],
+              result['read_p99_us'], result['read_max_us'], result['snapshots']))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import os, time
+import pytest
+from mtapi import Mtapi
+from benchmarks.fixtures import make_feed, ReplayMtapi
+
+# let app.py import without a local settings.cfg
+if not os.path.isfile('./settings.cfg'):
+    os.environ.setdefault('MTAPI_SETTINGS', os.path.abspath('./settings.cfg.sample'))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    '''Flask test client serving from a ReplayMtapi. Returns (client, feeds)
+    so tests can change the feed data.'''
+    import app
+
+    now = time.time()
+    feeds = {
+        Mtapi._FEED_URLS[0]: make_feed([
+            ('t1', '1', 'NORTH', [('103N', now + 60), ('101N', now + 120)]),
+            ('t2', '1', 'SOUTH', [('101S', now + 90), ('103S', now + 180)])
+        ], timestamp=now)
+    }
+    monkeypatch.setattr(app, 'mta', ReplayMtapi(feeds, expires_seconds=0))
+
+    return app.app.test_client(), feeds
@@ -0,0 +1,229 @@
+import datetime, logging, math, mmap, os, struct, zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from mtaproto.feedresponse import TZ
+from mtapi._mtapifile import StringTable, decode_strings, array_bytes, read_array
+
+logger = logging.getLogger(__name__)
+
+# An archive is a directory of segments, one per segment_seconds of recording
+# time, each a pair of append-only files named after the segment's start:
+#   <start>.dat  for every ingested feed, its raw protobuf and its extract,
+#                each compressed on its own
+#   <start>.idx  one _ENTRY per feed, in recording order
+# An extract holds the feed's stop times as columns sorted by stop, so the
+# arrivals at a station are one bisect into one small decompressed block:
+#   _EXTRACT, then the string table, then the times, stop, route, direction
+#   and trip columns. The columns besides times are refs into the string
+#   table.
+# Both files are little-endian.
+_ENTRY = struct.Struct('<qq16sQII')  # recorded, feed timestamp, feed name, offset, raw size, extract size
+_EXTRACT = struct.Struct('<II')  # rows, string table bytes
+COMPRESS_LEVEL = 6
+
+
+def encode_extract(stop_times):
+    '''Columnar extract of FeedResponse.stop_times() output.'''
+    strings = StringTable()
+    ref = strings.ref
+
+    rows = sorted((ref(stop_id), epoch, ref(route_id), ref(direction), ref(trip_id))
+                  for trip_id, route_id, direction, stop_id, epoch in stop_times)
+
+    columns = [ array('I'), array('q'), array('I'), array('I'), array('I') ]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+    stops, times, routes, directions, trips = columns
+
+    table = strings.encode()
+    return b''.join([_EXTRACT.pack(len(rows), len(table)), table] +
+                    [ array_bytes(column) for column in (times, stops, routes, directions, trips) ])
+
+
+class _Extract(object):
+    '''A decoded extract. Rows are sorted by stop, then time.'''
+
+    def __init__(self, data):
+        rows, table = _EXTRACT.unpack_from(data, 0)
+        offset = _EXTRACT.size
+        self.strings = decode_strings(data[offset:offset + table])
+        self._refs = { string: i for i, string in enumerate(self.strings) }
+        offset += table
+
+        self.times = read_array('q', data[offset:offset + 8 * rows])
+        offset += 8 * rows
+
+        columns = []
+        for _ in range(4):
+            columns.append(read_array('I', data[offset:offset + 4 * rows]))
+            offset += 4 * rows
+        self.stops, self.routes, self.directions, self.trips = columns
+
+    def __len__(self):
+        return len(self.times)
+
+    def rows(self, start=0, end=None):
+        '''(trip_id, route_id, direction, stop_id, epoch) tuples, like
+        FeedResponse.stop_times().'''
+        strings = self.strings
+        for i in range(start, len(self) if end is None else end):
+            yield (strings[self.trips[i]], strings[self.routes[i]], strings[self.directions[i]],
+                   strings[self.stops[i]], self.times[i])
+
+    def at_stop(self, stop_id):
+        '''Rows for one stop.'''
+        ref = self._refs.get(stop_id)
+        if ref is None:
+            return iter(())
+
+        return self.rows(bisect_left(self.stops, ref), bisect_right(self.stops, ref))
+
+    def on_route(self, route_id):
+        '''Rows for one route.'''
+        ref = self._refs.get(route_id)
+        if ref is None:
+            return iter(())
+
+        return ( row for i, row in zip(self.routes, self.rows()) if i == ref )
+
+
+class _Segment(object):
+    '''One segment, mapped read-only.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.idx', 'rb') as f:
+            index = f.read()
+        self.entries = [ _ENTRY.unpack_from(index, offset)
+                         for offset in range(0, len(index) - len(index) % _ENTRY.size, _ENTRY.size) ]
+
+        with open(path + '.dat', 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    def raw(self, entry):
+        _, _, _, offset, raw_size, _ = entry
+        return zlib.decompress(self._mm[offset:offset + raw_size])
+
+    def extract(self, entry):
+        _, _, _, offset, raw_size, extract_size = entry
+        start = offset + raw_size
+        return _Extract(zlib.decompress(self._mm[start:start + extract_size]))
+
+
+class _MtapiArchive(object):
+    '''Records every ingested feed to dir and reads them back by time. Times
+    are epoch seconds of recording, i.e. when the feed was ingested.'''
+
+    def __init__(self, dir, segment_seconds=3600):
+        self.dir = dir
+        self.segment_seconds = segment_seconds
+        self._start = None
+        self._dat = self._idx = None
+        os.makedirs(dir, exist_ok=True)
+
+    def _path(self, start):
+        return os.path.join(self.dir, '%d' % start)
+
+    def segments(self):
+        '''Start times of the segments on disk, in order.'''
+        return sorted(int(name[:-4]) for name in os.listdir(self.dir)
+                      if name.endswith('.idx') and name[:-4].isdigit())
+
+    def record(self, recorded, name, timestamp, raw, stop_times):
+        '''Append a feed that was ingested at recorded, with the stop times
+        extracted from it.'''
+        start = recorded - recorded % self.segment_seconds
+        if start != self._start:
+            self._open(start)
+
+        raw = zlib.compress(raw, COMPRESS_LEVEL)
+        extract = zlib.compress(encode_extract(stop_times), COMPRESS_LEVEL)
+        offset = self._dat.tell()
+        self._dat.write(raw)
+        self._dat.write(extract)
+        self._dat.flush()
+
+        # the index entry goes last, so readers never see a partial feed
+        self._idx.write(_ENTRY.pack(int(recorded), int(timestamp or 0), name.encode()[:16], offset,
+                                    len(raw), len(extract)))
+        self._idx.flush()
+
+    def _open(self, start):
+        self.close()
+        path = self._path(start)
+        self._dat = open(path + '.dat', 'ab')
+        self._idx = open(path + '.idx', 'ab')
+
+        # drop a partial entry left by a crash
+        size = self._idx.tell()
+        if size % _ENTRY.size:
+            self._idx.truncate(size - size % _ENTRY.size)
+            self._idx.seek(0, os.SEEK_END)
+
+        self._start = start
+
+    def close(self):
+        for f in (self._dat, self._idx):
+            if f:
+                f.close()
+        self._dat = self._idx = self._start = None
+
+    def _entries(self, since, until):
+        '''(segment, entry) for every feed recorded in [since, until], in
+        recording order.'''
+        for start in self.segments():
+            if start + self.segment_seconds <= since or start > until:
+                continue
+
+            try:
+                segment = _Segment(self._path(start))
+            except OSError as e:
+                logger.error('Couldn\'t read archive segment %d: %s', start, e)
+                continue
+
+            recorded = [ entry[0] for entry in segment.entries ]
+            for entry in segment.entries[bisect_left(recorded, since):bisect_right(recorded, until)]:
+                yield segment, entry
+
+    def feeds(self, since, until):
+        '''(recorded, name, raw) for every feed recorded in [since, until], in
+        recording order.'''
+        for segment, entry in self._entries(since, until):
+            yield entry[0], _name(entry), segment.raw(entry)
+
+    def extracts_at(self, at, max_age=1800):
+        '''The extract of each feed's last recording at or before at, skipping
+        feeds not recorded in the max_age seconds before it. Returns a list of
+        (recorded, name, timestamp, _Extract). Only those extracts are
+        decompressed.'''
+        latest = {}
+        for segment, entry in self._entries(at - max_age, at):
+            latest[_name(entry)] = (segment, entry)
+
+        return [ (entry[0], name, entry[1], segment.extract(entry))
+                 for name, (segment, entry) in latest.items() ]
+
+
+def _name(entry):
+    return entry[2].rstrip(b'\0').decode()
+
+def parse_time(value):
+    '''Epoch seconds from a query parameter holding either epoch seconds or an
+    ISO 8601 time; times without an offset are New York time. Raises
+    ValueError.'''
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        if not math.isfinite(seconds):
+            raise ValueError('time must be finite: %r' % value)
+        return int(seconds)
+
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = TZ.localize(parsed)
+
+    return int(parsed.timestamp())
@@ -0,0 +1,247 @@
+import csv, hashlib, struct
+from collections import defaultdict
+from mtapi._mtapifile import StringTable, decode_strings, read_array, open_csv
+
+# Station catalog layout, little-endian:
+#   header
+#   string table: every stop, station and route id
+#   one _STOP per stop: (stop ref, station ref)
+#   one _CELL per spatial index cell, then station refs
+#   one _ROUTE per route, then station refs in southbound line order
+# The digest is the SHA-1 of the stations.json the catalog was built with;
+# a catalog that doesn't match the stations file is ignored.
+MAGIC = b'MTAPICT2'
+_HEADER = struct.Struct('<8s20sddIIII')  # magic, digest, cell size, lat0, string bytes, stops, cells, routes
+_STOP = struct.Struct('<II')
+_CELL = struct.Struct('<iiI')  # x, y, stations
+_ROUTE = struct.Struct('<II')  # id, stations
+
+
+def stations_digest(data):
+    return hashlib.sha1(data).digest()
+
+
+def _line_order(members, edges, key):
+    '''Order members topologically by (before, after) edges, following one
+    branch to its end before starting the next so branches stay contiguous.
+    Edges may pass through stations outside members. Ties go by key; a cycle
+    is broken at its least constrained station.'''
+    successors = defaultdict(set)
+    indegree = defaultdict(int)
+    nodes = set(members)
+    for before, after in edges:
+        nodes.add(before)
+        nodes.add(after)
+        if after not in successors[before]:
+            successors[before].add(after)
+            indegree[after] += 1
+
+    sort_key = lambda node: (key(node), node)
+    # a stack of ready nodes, smallest key on top
+    ready = sorted((node for node in nodes if not indegree[node]), key=sort_key, reverse=True)
+    placed = []
+    seen = set()
+
+    while len(seen) < len(nodes):
+        if not ready:
+            ready.append(min((node for node in nodes if node not in seen),
+                             key=lambda node: (indegree[node], sort_key(node))))
+
+        node = ready.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        placed.append(node)
+
+        unlocked = []
+        for after in successors[node]:
+            indegree[after] -= 1
+            if indegree[after] == 0 and after not in seen:
+                unlocked.append(after)
+        ready.extend(sorted(unlocked, key=sort_key, reverse=True))
+
+    return [ node for node in placed if node in members ]
+
+
+class _UnionFind(object):
+    def __init__(self):
+        self._parent = {}
+
+    def find(self, item):
+        parent = self._parent.setdefault(item, item)
+        if parent != item:
+            root = self.find(parent)
+            self._parent[item] = root
+            return root
+
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            # the smaller id names the group
+            if b < a:
+                a, b = b, a
+            self._parent[b] = a
+
+
+def build_stations(gtfs_dir):
+    '''Group the stops in a static GTFS directory into stations, in the
+    stations.json format. Platforms join their parent station, and stops
+    join across transfers.txt, transitively.'''
+    groups = _UnionFind()
+    stops = {}
+    with open_csv(gtfs_dir, 'stops.txt') as f:
+        for row in csv.DictReader(f):
+            groups.find(row['stop_id'])
+            if row.get('parent_station'):
+                groups.union(row['parent_station'], row['stop_id'])
+            else:
+                stops[row['stop_id']] = row
+
+    try:
+        with open_csv(gtfs_dir, 'transfers.txt') as f:
+            for row in csv.DictReader(f):
+                groups.union(row['from_stop_id'], row['to_stop_id'])
+    except FileNotFoundError:
+        pass
+
+    members = defaultdict(list)
+    for stop_id in stops:
+        members[groups.find(stop_id)].append(stop_id)
+
+    stations = {}
+    for stop_ids in members.values():
+        # a station is named after its smallest stop id
+        stop_ids.sort()
+        points = { id: [float(stops[id]['stop_lat']), float(stops[id]['stop_lon'])] for id in stop_ids }
+        stations[stop_ids[0]] = {
+            'id': stop_ids[0],
+            'name': ' / '.join(sorted(set(stops[id]['stop_name'] for id in stop_ids))),
+            'location': [
+                sum(p[0] for p in points.values()) / len(points),
+                sum(p[1] for p in points.values()) / len(points)
+            ],
+            'stops': points
+        }
+
+    return stations
+
+def route_orders(gtfs_dir, stations):
+    '''Each route's station ids in southbound line order, from the trips in
+    a static GTFS directory. stop_times.txt is streamed.'''
+    station_of = {}
+    for station_id, station in stations.items():
+        for stop_id in station['stops']:
+            station_of[stop_id] = station_id
+
+    with open_csv(gtfs_dir, 'stops.txt') as f:
+        for row in csv.DictReader(f):
+            parent = row.get('parent_station')
+            if parent in station_of:
+                station_of[row['stop_id']] = station_of[parent]
+
+    trips = {}
+    with open_csv(gtfs_dir, 'trips.txt') as f:
+        for row in csv.DictReader(f):
+            route_id = row['route_id'].upper()
+            trips[row['trip_id']] = 'S' if route_id == 'GS' else route_id
+
+    members = defaultdict(set)
+    edges = defaultdict(set)
+    with open_csv(gtfs_dir, 'stop_times.txt') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        trip_col, stop_col, sequence_col = header.index('trip_id'), header.index('stop_id'), header.index('stop_sequence')
+
+        last = None
+        for row in reader:
+            route_id = trips.get(row[trip_col])
+            station_id = station_of.get(row[stop_col])
+            if route_id is None or station_id is None:
+                continue
+
+            members[route_id].add(station_id)
+            trip = (row[trip_col], int(row[sequence_col]), station_id)
+            # a trip's consecutive stations give the order of its line
+            if last and last[0] == trip[0] and last[1] < trip[1] and last[2] != station_id:
+                if row[stop_col].endswith('N'):
+                    edges[route_id].add((station_id, last[2]))
+                else:
+                    edges[route_id].add((last[2], station_id))
+            last = trip
+
+    return { route_id: _line_order(ids, edges[route_id], lambda id: stations[id]['name'])
+             for route_id, ids in members.items() }
+
+def encode_catalog(stations, routes, digest, spatial_index):
+    '''Serialize a catalog for the given stations, routes (route_id ->
+    ordered station ids) and _SpatialIndex over the stations.'''
+    strings = StringTable()
+    ref, refs = strings.ref, strings.refs
+
+    body = []
+    stops = [ (stop_id, station_id) for station_id in sorted(stations)
+              for stop_id in sorted(stations[station_id]['stops']) ]
+    for stop_id, station_id in stops:
+        body.append(_STOP.pack(ref(stop_id), ref(station_id)))
+
+    cells = spatial_index.cells()
+    for (x, y), keys in sorted(cells.items()):
+        body.append(_CELL.pack(x, y, len(keys)) + refs(keys))
+
+    for route_id, station_ids in sorted(routes.items()):
+        body.append(_ROUTE.pack(ref(route_id), len(station_ids)) + refs(station_ids))
+
+    table = strings.encode()
+    header = _HEADER.pack(MAGIC, digest, spatial_index.cell_size, spatial_index.lat0, len(table),
+                          len(stops), len(cells), len(routes))
+
+    return b''.join([header, table] + body)
+
+
+class _MtapiCatalog(object):
+    '''A station catalog read from disk: the stop to station map, the
+    spatial index cells and each route's line order.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        try:
+            self._read(data)
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise ValueError('%s is truncated or corrupt' % path)
+
+    def _read(self, data):
+        magic, self.digest, self.cell_size, self.lat0, table, n_stops, n_cells, n_routes = \
+            _HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a catalog file')
+
+        offset = _HEADER.size
+        strings = decode_strings(data[offset:offset + table])
+        offset += table
+
+        def refs(count):
+            return [ strings[value] for value in read_array('I', data[offset:offset + 4 * count]) ]
+
+        self.stops = {}
+        for _ in range(n_stops):
+            stop, station = _STOP.unpack_from(data, offset)
+            self.stops[strings[stop]] = strings[station]
+            offset += _STOP.size
+
+        self.cells = {}
+        for _ in range(n_cells):
+            x, y, count = _CELL.unpack_from(data, offset)
+            offset += _CELL.size
+            self.cells[(x, y)] = refs(count)
+            offset += 4 * count
+
+        self.routes = {}
+        for _ in range(n_routes):
+            id, count = _ROUTE.unpack_from(data, offset)
+            offset += _ROUTE.size
+            self.routes[strings[id]] = tuple(refs(count))
+            offset += 4 * count
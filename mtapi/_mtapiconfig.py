@@ -0,0 +1,70 @@
+import os, types
+
+# settings every entry point (app.py, asgi.py, updater.py) understands; see
+# the README for what each one does
+DEFAULTS = {
+    'DEBUG': False,
+    'MAX_TRAINS': 10,
+    'MAX_MINUTES': 30,
+    'CACHE_SECONDS': 60,
+    'THREADED': True,
+    'FEED_TIMEOUT': 10,
+    'UPDATE_DEADLINE': 15,
+    'STREAM_KEEPALIVE': 15,
+    'STREAM_POLL_SECONDS': 1,
+    'SHARED_FILE': None,
+    'STATE_DIR': None,
+    'MAX_BATCH_QUERIES': 100,
+    'COMPACT_JSON': False,
+    'STALE_SECONDS': 0,
+    'ARCHIVE_DIR': None,
+    'ARCHIVE_SEGMENT_SECONDS': 3600,
+    'SCHEDULE_FILE': None,
+    'SCHEDULE_AFTER': 300,
+    'CATALOG_FILE': None
+}
+
+SETTINGS_ENV_VAR = 'MTAPI_SETTINGS'
+SETTINGS_DEFAULT_PATH = './settings.cfg'
+
+
+def load_config():
+    '''DEFAULTS overridden by the settings file named by $MTAPI_SETTINGS, or
+    by ./settings.cfg. Like Flask's Config.from_pyfile, the file is Python and
+    only its uppercase names are settings.'''
+    if SETTINGS_ENV_VAR in os.environ:
+        path = os.environ[SETTINGS_ENV_VAR]
+    elif os.path.isfile(SETTINGS_DEFAULT_PATH):
+        path = SETTINGS_DEFAULT_PATH
+    else:
+        raise Exception('No configuration found! Create a settings.cfg file or set MTAPI_SETTINGS env variable.')
+
+    module = types.ModuleType('config')
+    module.__file__ = path
+    with open(path, 'rb') as f:
+        exec(compile(f.read(), path, 'exec'), module.__dict__)
+
+    config = dict(DEFAULTS)
+    config.update((name, value) for name, value in vars(module).items() if name.isupper())
+    return config
+
+def mtapi_options(config):
+    '''Mtapi keyword arguments from the settings; entry points add their own
+    shared_role and autoupdate.'''
+    return {
+        'max_trains': config['MAX_TRAINS'],
+        'max_minutes': config['MAX_MINUTES'],
+        'expires_seconds': config['CACHE_SECONDS'],
+        'threaded': config['THREADED'],
+        'feed_timeout': config['FEED_TIMEOUT'],
+        'update_deadline': config['UPDATE_DEADLINE'],
+        'shared_file': config['SHARED_FILE'],
+        'state_dir': config['STATE_DIR'],
+        'compact_json': config['COMPACT_JSON'],
+        'stale_seconds': config['STALE_SECONDS'],
+        'archive_dir': config['ARCHIVE_DIR'],
+        'archive_segment_seconds': config['ARCHIVE_SEGMENT_SECONDS'],
+        'schedule_file': config['SCHEDULE_FILE'],
+        'schedule_after': config['SCHEDULE_AFTER'],
+        'catalog_file': config['CATALOG_FILE']
+    }
@@ -0,0 +1,67 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# bodies smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+# strong validators differ per content-coding
+_ETAG_SUFFIXES = {'gzip': '-gz', 'br': '-br'}
+
+
+def choose_encoding(accept_encoding):
+    '''Pick 'br', 'gzip' or None (identity) from an Accept-Encoding header.'''
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip().lower())
+
+    if brotli and 'br' in accepted:
+        return 'br'
+    elif 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+
+    return None
+
+def snapshot_etag(snapshot, encoding):
+    '''ETag for a response rendered from an Mtapi._Snapshot and sent with
+    the given content-coding. Every process following one producer tags the
+    same snapshot alike.'''
+    return '%s-%d%s' % (snapshot.producer, snapshot.version, _ETAG_SUFFIXES.get(encoding, ''))
+
+
+class _Envelope(object):
+    '''A rendered {data, updated} response body. Compressed forms are made on
+    first request and kept with the body, which lives as long as its
+    snapshot.'''
+
+    __slots__ = ('body', 'updated', '_encoded')
+
+    def __init__(self, body, updated):
+        self.body = body
+        self.updated = updated
+        self._encoded = {}
+
+    def encode(self, encoding):
+        '''Returns (body, encoding) for the requested encoding, falling back to
+        the identity encoding (None) for small bodies.'''
+        if encoding is None or len(self.body) < MIN_COMPRESS_SIZE:
+            return self.body, None
+
+        try:
+            return self._encoded[encoding], encoding
+        except KeyError:
+            pass
+
+        if encoding == 'br':
+            data = brotli.compress(self.body, quality=5)
+        else:
+            data = gzip.compress(self.body, compresslevel=6, mtime=0)
+
+        self._encoded[encoding] = data
+        return data, encoding
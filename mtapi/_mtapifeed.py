@@ -0,0 +1,106 @@
+import math, random
+
+
+class _MtapiFeed(object):
+    '''Refresh state for a single MTA feed URL.'''
+
+    # seconds after a feed's expected publish time to fetch it
+    PUBLISH_DELAY = 2
+    MAX_BACKOFF = 300
+
+    def __init__(self, url, interval=60):
+        self.url = url
+        self.name = url.rsplit('%2F', 1)[-1]
+        self.interval = interval
+        self.etag = None
+        self.last_modified = None
+        # validators of the last download, kept until its data is applied
+        self.fetched_validators = None
+        self.timestamp = None
+        self.updated = None
+        self.next_refresh = 0
+        self.failures = 0
+        self.pending = None
+
+        # the protobuf the current data was extracted from, and the header
+        # timestamp of the copy last saved to disk
+        self.raw = None
+        self.saved_timestamp = None
+
+        # station_id -> direction -> Mtapi._Arrivals
+        self.arrivals = {}
+        # route_id -> set of stop ids
+        self.routes = {}
+        # route_id -> set of (station_id, station_id) pairs that trips visit
+        # one after the other, in southbound order
+        self.edges = {}
+        # trip_id -> Mtapi._Trip
+        self.trips = {}
+
+    def is_due(self, now):
+        if self.pending and not self.pending.done():
+            return False
+
+        return now >= self.next_refresh
+
+    def schedule(self, now):
+        '''Schedule the next fetch after a successful one. The MTA publishes
+        each feed every interval seconds, so fetch just after the next publish
+        expected from the feed's header timestamp rather than on a fixed timer
+        that drifts against it.'''
+        self.failures = 0
+        if not self.interval:
+            self.next_refresh = now
+        elif not self.timestamp:
+            self.next_refresh = now + self.interval
+        else:
+            published = self.timestamp + self.PUBLISH_DELAY
+            slots = math.floor((now - published) / self.interval) + 1
+            self.next_refresh = published + max(slots, 1) * self.interval
+
+    def backoff(self, now):
+        '''Schedule a retry after a failed fetch, backing off exponentially
+        with jitter so retries from many processes don't line up.'''
+        self.failures += 1
+        if not self.interval:
+            self.next_refresh = now
+            return
+
+        delay = min(self.interval * 2 ** (self.failures - 1), max(self.interval, self.MAX_BACKOFF))
+        self.next_refresh = now + delay * random.uniform(0.5, 1)
+
+    def request_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+    def fetched(self, headers):
+        '''Hold a download's validators. They aren't sent until
+        commit_validators(), so a download that is dropped or fails to
+        parse is fetched again in full rather than answered with a 304.'''
+        self.fetched_validators = (headers.get('ETag'), headers.get('Last-Modified'))
+
+    def commit_validators(self):
+        if self.fetched_validators:
+            self.etag, self.last_modified = self.fetched_validators
+        self.fetched_validators = None
+
+    def set_data(self, timestamp, updated, arrivals, routes, edges, trips, raw=None):
+        '''Replace this feed's extracted data. Returns the ids of every station
+        touched by the old or the new data.'''
+        touched = set(self.arrivals)
+        touched.update(arrivals)
+
+        self.timestamp = timestamp
+        self.updated = updated
+        self.arrivals = arrivals
+        self.routes = routes
+        self.edges = edges
+        self.trips = trips
+        self.raw = raw
+
+        return touched
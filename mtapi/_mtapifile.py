@@ -0,0 +1,70 @@
+import os, sys
+from array import array
+
+# Helpers shared by the binary files MTAPI writes: snapshots, archives,
+# schedule indexes and station catalogs. Each is built on one machine and may
+# be read on another, so every number in them is little-endian: structs use
+# '<' and arrays are swapped on big-endian hosts.
+_SWAP = sys.byteorder != 'little'
+
+
+class StringTable(object):
+    '''Collects the strings a file refers to by index. Stored as utf-8, each
+    string terminated by a NUL.'''
+
+    def __init__(self):
+        self._refs = {}
+
+    def __len__(self):
+        return len(self._refs)
+
+    def ref(self, value):
+        index = self._refs.get(value)
+        if index is None:
+            index = self._refs[value] = len(self._refs)
+
+        return index
+
+    def refs(self, values):
+        '''Little-endian bytes of the refs of values.'''
+        return array_bytes(array('I', [ self.ref(value) for value in values ]))
+
+    def encode(self):
+        return b''.join(value.encode() + b'\0' for value in self._refs)
+
+def decode_strings(data, intern=False):
+    '''The strings of an encoded StringTable.'''
+    strings = bytes(data).decode().split('\0')[:-1]
+    if intern:
+        strings = [ sys.intern(string) for string in strings ]
+
+    return strings
+
+def array_bytes(values):
+    '''Little-endian bytes of an array.'''
+    if _SWAP and values.itemsize > 1:
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return values.tobytes()
+
+def read_array(typecode, data):
+    '''An array decoded from little-endian bytes.'''
+    values = array(typecode)
+    values.frombytes(data)
+    if _SWAP and values.itemsize > 1:
+        values.byteswap()
+
+    return values
+
+def array_view(view, typecode):
+    '''A memoryview of little-endian numbers, cast in place where the host is
+    little-endian and decoded into an array where it isn't.'''
+    if _SWAP:
+        return read_array(typecode, view)
+
+    return view.cast(typecode)
+
+def open_csv(gtfs_dir, name):
+    '''Open one of the files of a static GTFS directory.'''
+    return open(os.path.join(gtfs_dir, name), newline='', encoding='utf-8-sig')
@@ -0,0 +1,89 @@
+import threading, math
+
+
+class _MtapiMetrics(object):
+    '''Counters, gauges and histograms, rendered in the Prometheus text
+    exposition format.'''
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [type, help, {labels: value}]
+        self._metrics = {}
+
+    def describe(self, name, type, help):
+        with self._lock:
+            self._metrics.setdefault(name, [type, help, {}])
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values(name, 'counter')
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values(name, 'gauge')[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values(name, 'histogram')
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = [[0] * len(self.BUCKETS), 0, 0.0]
+
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._metrics.get(name, [None, None, {}])[2].get(self._key(labels))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._metrics):
+                type, help, values = self._metrics[name]
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+
+                for key in sorted(values):
+                    if type == 'histogram':
+                        buckets, count, total = values[key]
+                        for bound, bucket_count in zip(self.BUCKETS, buckets):
+                            lines.append('%s_bucket%s %d' % (name, self._labels(key + (('le', repr(float(bound))),)), bucket_count))
+                        lines.append('%s_bucket%s %d' % (name, self._labels(key + (('le', '+Inf'),)), count))
+                        lines.append('%s_count%s %d' % (name, self._labels(key), count))
+                        lines.append('%s_sum%s %s' % (name, self._labels(key), self._number(total)))
+                    else:
+                        lines.append('%s%s %s' % (name, self._labels(key), self._number(values[key])))
+
+        return '\n'.join(lines) + '\n'
+
+    def _values(self, name, type):
+        return self._metrics.setdefault(name, [type, name, {}])[2]
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _labels(key):
+        if not key:
+            return ''
+
+        escaped = ( (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in key )
+        return '{%s}' % ','.join('%s="%s"' % item for item in escaped)
+
+    @staticmethod
+    def _number(value):
+        if isinstance(value, float) and (math.isinf(value) or math.isnan(value)):
+            return {math.inf: '+Inf', -math.inf: '-Inf'}.get(value, 'NaN')
+
+        return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,94 @@
+import threading
+
+
+class _Subscription(object):
+    '''A client's interest in a set of stations and routes. Changes are
+    coalesced into a set of station ids so a slow reader never falls behind by
+    more than one update.'''
+
+    def __init__(self, broker, snapshot, station_ids, routes, on_change=None):
+        self.station_ids = frozenset(station_ids)
+        self.routes = frozenset(route.upper() for route in routes)
+        self.on_change = on_change
+        self.closed = False
+        self._broker = broker
+        self._changed = set()
+        self._watching = frozenset(self.resolve(snapshot))
+        self._cond = threading.Condition()
+
+    def resolve(self, snapshot):
+        '''Station ids this subscription covers in the given snapshot.'''
+        ids = set(self.station_ids)
+        for route in self.routes:
+            ids.update(snapshot.route_stations.get(route, ()))
+
+        return ids
+
+    def notify(self, snapshot, changed):
+        watching = self.resolve(snapshot)
+        ids = (watching & changed) | (watching - self._watching)
+        self._watching = frozenset(watching)
+
+        if ids:
+            with self._cond:
+                self._changed |= ids
+                self._cond.notify()
+
+            if self.on_change:
+                self.on_change()
+
+    def wait(self, timeout=None):
+        '''Block until some of the subscribed stations change. Returns the ids
+        of the changed stations, or an empty set on timeout or close.'''
+        with self._cond:
+            self._cond.wait_for(lambda: self._changed or self.closed, timeout)
+            changed, self._changed = self._changed, set()
+
+        return changed
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+        self._broker.unsubscribe(self)
+
+
+class _PushBroker(object):
+    '''Fans out snapshot changes to subscriptions.'''
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, snapshot, station_ids=(), routes=(), on_change=None):
+        subscription = _Subscription(self, snapshot, station_ids, routes, on_change)
+
+        with self._lock:
+            self._subscriptions.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, old, new, dirty):
+        '''Notify subscribers about the stations in dirty whose trains differ
+        between the old and new snapshot.'''
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+
+        if not subscriptions:
+            return
+
+        changed = set()
+        for id in dirty:
+            if not old.stations[id].same_trains(new.stations[id]):
+                changed.add(id)
+
+        for subscription in subscriptions:
+            subscription.notify(new, changed)
@@ -0,0 +1,228 @@
+import csv, datetime, mmap, struct
+from array import array
+from bisect import bisect_left, bisect_right
+from mtaproto.feedresponse import TZ
+from mtapi._mtapifile import StringTable, decode_strings, array_bytes, array_view, open_csv
+
+# Schedule index layout, little-endian:
+#   header
+#   string table: every stop, route, trip, service and direction id
+#   one _SERVICE per service_id in calendar.txt, then one _EXCEPTION per row
+#     of calendar_dates.txt
+#   one _STOP per stop: the range of rows holding its stop times
+#   columns, one entry per stop time, grouped by stop and sorted by time:
+#     seconds after the service day's midnight, then route, direction and
+#     trip refs, then service indexes
+# Refs index the string table. Stops are parent stops, as in the realtime
+# feeds; directions come from the platform stop id's N or S suffix.
+MAGIC = b'MTAPISC2'
+_HEADER = struct.Struct('<8sIIIII')  # magic, string bytes, services, exceptions, stops, rows
+_SERVICE = struct.Struct('<IBII')  # id, weekday bits (Monday = 1), start date, end date
+_EXCEPTION = struct.Struct('<IIB')  # service, date, 1 = added or 2 = removed
+_STOP = struct.Struct('<III')  # id, first row, end row
+_WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+def _seconds(value):
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+def _date(value):
+    return int(value.replace('-', ''))
+
+def build_schedule(gtfs_dir):
+    '''Build a schedule index from the GTFS files in gtfs_dir. stop_times.txt
+    is streamed, one row at a time, into per-stop arrays.'''
+    strings = StringTable()
+    ref = strings.ref
+
+    services = {}
+    try:
+        with open_csv(gtfs_dir, 'calendar.txt') as f:
+            for row in csv.DictReader(f):
+                weekdays = sum(1 << i for i, day in enumerate(_WEEKDAYS) if row[day] == '1')
+                services[row['service_id']] = (len(services), weekdays, _date(row['start_date']),
+                                               _date(row['end_date']))
+    except FileNotFoundError:
+        pass
+
+    exceptions = []
+    try:
+        with open_csv(gtfs_dir, 'calendar_dates.txt') as f:
+            for row in csv.DictReader(f):
+                if row['service_id'] not in services:
+                    # a service defined only by its dates
+                    services[row['service_id']] = (len(services), 0, 0, 0)
+                exceptions.append((services[row['service_id']][0], _date(row['date']),
+                                   int(row['exception_type'])))
+    except FileNotFoundError:
+        pass
+
+    trips = {}
+    with open_csv(gtfs_dir, 'trips.txt') as f:
+        for row in csv.DictReader(f):
+            route_id = row['route_id'].upper()
+            if route_id == 'GS':
+                route_id = 'S'
+            if row['service_id'] not in services:
+                services[row['service_id']] = (len(services), 0, 0, 0)
+            trips[row['trip_id']] = (ref(route_id), services[row['service_id']][0], ref(row['trip_id']))
+
+    # stop -> (seconds, routes, directions, trips, services)
+    stops = {}
+    with open_csv(gtfs_dir, 'stop_times.txt') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        trip_col, stop_col = header.index('trip_id'), header.index('stop_id')
+        arrival_col, departure_col = header.index('arrival_time'), header.index('departure_time')
+
+        for row in reader:
+            trip = trips.get(row[trip_col])
+            stop_id = row[stop_col]
+            direction = stop_id[3:]
+            if trip is None or direction not in ('N', 'S'):
+                continue
+
+            columns = stops.get(stop_id[:3])
+            if columns is None:
+                columns = stops[stop_id[:3]] = (array('i'), array('I'), array('I'), array('I'), array('H'))
+            route, service, trip_ref = trip
+            for column, value in zip(columns, (_seconds(row[arrival_col] or row[departure_col]),
+                                               route, ref(direction), trip_ref, service)):
+                column.append(value)
+
+    stop_records = []
+    merged = [ array('i'), array('I'), array('I'), array('I'), array('H') ]
+    for stop_id, columns in stops.items():
+        order = sorted(range(len(columns[0])), key=columns[0].__getitem__)
+        start = len(merged[0])
+        for column, out in zip(columns, merged):
+            out.extend(column[i] for i in order)
+        stop_records.append(_STOP.pack(ref(stop_id), start, len(merged[0])))
+
+    service_records = []
+    for service_id, (_, weekdays, start_date, end_date) in sorted(services.items(), key=lambda item: item[1][0]):
+        service_records.append(_SERVICE.pack(ref(service_id), weekdays, start_date, end_date))
+
+    table = strings.encode()
+    return b''.join([
+        _HEADER.pack(MAGIC, len(table), len(services), len(exceptions), len(stops), len(merged[0])),
+        table
+    ] + service_records + [ _EXCEPTION.pack(*exception) for exception in exceptions ] + stop_records
+      + [ array_bytes(column) for column in merged ])
+
+
+class _MtapiSchedule(object):
+    '''A schedule index mapped read-only. The stop time columns are read in
+    place; only the stop directory and the calendar are decoded on load.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self._read_index()
+        except (struct.error, UnicodeDecodeError):
+            raise ValueError('%s is truncated or corrupt' % path)
+
+        self._active = {}
+        self._route_stops = None
+
+    def _read_index(self):
+        mm = self._mm
+        magic, table, n_services, n_exceptions, n_stops, rows = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a schedule file')
+
+        offset = _HEADER.size
+        self.strings = decode_strings(mm[offset:offset + table])
+        offset += table
+
+        self.services = []
+        for _ in range(n_services):
+            _, weekdays, start_date, end_date = _SERVICE.unpack_from(mm, offset)
+            self.services.append((weekdays, start_date, end_date))
+            offset += _SERVICE.size
+
+        # date -> {service: exception type}
+        self.exceptions = {}
+        for _ in range(n_exceptions):
+            service, date, kind = _EXCEPTION.unpack_from(mm, offset)
+            self.exceptions.setdefault(date, {})[service] = kind
+            offset += _EXCEPTION.size
+
+        self.stops = {}
+        for _ in range(n_stops):
+            id, start, end = _STOP.unpack_from(mm, offset)
+            self.stops[self.strings[id]] = (start, end)
+            offset += _STOP.size
+
+        view = memoryview(mm)
+        self._seconds = array_view(view[offset:offset + 4 * rows], 'i')
+        offset += 4 * rows
+        self._routes = array_view(view[offset:offset + 4 * rows], 'I')
+        offset += 4 * rows
+        self._directions = array_view(view[offset:offset + 4 * rows], 'I')
+        offset += 4 * rows
+        self._trips = array_view(view[offset:offset + 4 * rows], 'I')
+        offset += 4 * rows
+        self._services = array_view(view[offset:offset + 2 * rows], 'H')
+        if len(self._services) != rows:
+            raise ValueError('Schedule file is truncated')
+
+    def active_services(self, date):
+        '''Indexes of the services running on a datetime.date.'''
+        try:
+            return self._active[date]
+        except KeyError:
+            pass
+
+        key = date.year * 10000 + date.month * 100 + date.day
+        bit = 1 << date.weekday()
+        active = { i for i, (weekdays, start_date, end_date) in enumerate(self.services)
+                   if weekdays & bit and start_date <= key <= end_date }
+        for service, kind in self.exceptions.get(key, {}).items():
+            if kind == 1:
+                active.add(service)
+            else:
+                active.discard(service)
+
+        self._active[date] = active = frozenset(active)
+        return active
+
+    def route_stops(self):
+        '''route_id -> frozenset of the stops it serves on any day.'''
+        if self._route_stops is None:
+            route_stops = {}
+            for stop_id, (first, last) in self.stops.items():
+                for route in set(self._routes[first:last]):
+                    route_stops.setdefault(self.strings[route], set()).add(stop_id)
+            self._route_stops = { route_id: frozenset(stops) for route_id, stops in route_stops.items() }
+
+        return self._route_stops
+
+    def arrivals(self, stop_id, start, end):
+        '''Scheduled (route_id, direction, epoch, trip_id) at a stop between
+        start and end (epoch seconds), by service day.'''
+        try:
+            first, last = self.stops[stop_id]
+        except KeyError:
+            return
+
+        strings = self.strings
+        day = datetime.datetime.fromtimestamp(start, TZ).date() - datetime.timedelta(days=1)
+        end_day = datetime.datetime.fromtimestamp(end, TZ).date()
+        while day <= end_day:
+            # GTFS times count from noon minus 12 hours, which is midnight
+            # except on days the clocks change
+            base = int(TZ.localize(datetime.datetime(day.year, day.month, day.day, 12)).timestamp()) - 12 * 3600
+            active = self.active_services(day)
+
+            lo = bisect_left(self._seconds, start - base, first, last)
+            hi = bisect_right(self._seconds, end - base, lo, last)
+            for i in range(lo, hi):
+                if self._services[i] in active:
+                    yield (strings[self._routes[i]], strings[self._directions[i]], base + self._seconds[i],
+                           strings[self._trips[i]])
+
+            day += datetime.timedelta(days=1)
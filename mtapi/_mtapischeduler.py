@@ -0,0 +1,47 @@
+import threading, time, logging
+
+
+logger = logging.getLogger(__name__)
+
+class _MtapiScheduler(object):
+    '''One long-lived thread that refreshes an Mtapi whenever its next feed is
+    due. Updates run on the scheduler thread itself, so they never overlap.'''
+
+    MIN_DELAY = 1
+
+    def __init__(self, mtapi, max_delay=60):
+        self.mtapi = mtapi
+        self.max_delay = max(max_delay or 0, self.MIN_DELAY)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        logger.info('Starting update thread...')
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='mtapi-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        '''Stop after the update in progress, if any, finishes.'''
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def delay(self):
+        '''Seconds until the earliest feed is due, within MIN_DELAY and
+        max_delay so expired stations are still rebuilt when no feed is.'''
+        next_refresh = self.mtapi.next_refresh()
+        delay = next_refresh - time.time() if next_refresh is not None else self.max_delay
+
+        return min(max(delay, self.MIN_DELAY), self.max_delay)
+
+    def run(self):
+        '''The scheduler loop. Runs in the calling thread until stopped.'''
+        while not self._stop.wait(self.delay()):
+            try:
+                self.mtapi._update()
+            except Exception:
+                logger.exception('Update failed')
@@ -0,0 +1,251 @@
+import mmap, os, struct
+from array import array
+from collections.abc import Mapping
+from mtapi._mtapifile import StringTable, decode_strings, array_bytes, read_array
+
+# Snapshot file layout, little-endian:
+#   header
+#   string table: every station, stop, route and trip id
+#   one record per station: _STATION, then route refs, N times, N route refs,
+#     N trip refs, N scheduled flags, then the same for S
+#   one record per route: _ROUTE, then stop refs and station refs
+#   one record per trip: _TRIP, then station refs and times
+# Refs index the string table. Missing times are stored as -1.
+# producer identifies the process that numbered the versions.
+# next_refresh is when the writer expects to refresh next, 0 if unknown.
+MAGIC = b'MTAPISN6'
+_HEADER = struct.Struct('<8s4sqqddIIII')  # magic, producer, version, updated, last_update, next_refresh, string bytes, stations, routes, trips
+_STATION = struct.Struct('<IqqIII')  # id, last_update, valid_until, routes, N, S
+_ROUTE = struct.Struct('<III')  # id, stops, stations
+_TRIP = struct.Struct('<IIIqI')  # id, route, direction, last_update, stops
+_NONE = -1
+
+
+def encode_snapshot(snapshot, next_refresh=None):
+    '''Serialize an Mtapi._Snapshot. Only train data is stored; names,
+    locations and stops come from each reader's own stations file.'''
+    strings = StringTable()
+    ref, refs = strings.ref, strings.refs
+
+    body = []
+    for id, station in snapshot.stations.items():
+        north, south = station.trains['N'], station.trains['S']
+        body.append(b''.join([
+            _STATION.pack(ref(id),
+                          int(station.last_update.timestamp()) if station.last_update else _NONE,
+                          int(station.valid_until) if station.valid_until else _NONE,
+                          len(station.routes), len(north), len(south)),
+            refs(sorted(station.routes)),
+            array_bytes(north.times), refs(north.routes), refs(north.trips), north.scheduled.tobytes(),
+            array_bytes(south.times), refs(south.routes), refs(south.trips), south.scheduled.tobytes()
+        ]))
+
+    for route_id, stop_ids in snapshot.routes.items():
+        station_ids = snapshot.route_stations.get(route_id, ())
+        body.append(b''.join([
+            _ROUTE.pack(ref(route_id), len(stop_ids), len(station_ids)),
+            refs(sorted(stop_ids)),
+            refs(station_ids)
+        ]))
+
+    for trip_id, trip in snapshot.trips.items():
+        body.append(b''.join([
+            _TRIP.pack(ref(trip_id), ref(trip.route), ref(trip.direction),
+                       int(trip.last_update.timestamp()) if trip.last_update else _NONE, len(trip)),
+            refs(trip.stations),
+            array_bytes(trip.times)
+        ]))
+
+    table = strings.encode()
+    header = _HEADER.pack(MAGIC, bytes.fromhex(snapshot.producer), snapshot.version, snapshot.updated, snapshot.last_update.timestamp(),
+                          next_refresh or 0, len(table), len(snapshot.stations), len(snapshot.routes), len(snapshot.trips))
+
+    return b''.join([header, table] + body)
+
+def write_snapshot(path, snapshot, fsync=False, next_refresh=None):
+    '''Atomically replace path with an encoded snapshot. Readers that have the
+    old file mapped keep reading it until they swap.'''
+    write_file(path, encode_snapshot(snapshot, next_refresh), fsync)
+
+def write_file(path, data, fsync=False):
+    '''Write data to a temporary file and rename it over path, so path is
+    always either the old or the new contents.'''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+    os.replace(tmp, path)
+
+def file_key(path):
+    '''Identifies one version of a snapshot file. Raises OSError if the file
+    doesn't exist.'''
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class _SharedSnapshot(object):
+    '''A snapshot file mapped read-only. Station records are decoded on
+    demand; routes are decoded up front.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.key = st.st_ino, st.st_mtime_ns, st.st_size
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self._read_index()
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise ValueError('%s is truncated or corrupt' % path)
+
+    def _read_index(self):
+        mm = self._mm
+        magic, producer, self.version, self.updated, self.last_update, self.next_refresh, table, n_stations, n_routes, \
+            n_trips = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a snapshot file')
+        self.producer = producer.hex()
+        self.next_refresh = self.next_refresh or None
+
+        offset = _HEADER.size
+        strings = self._strings = decode_strings(mm[offset:offset + table], intern=True)
+        offset += table
+
+        # station id -> (start, end) of its record
+        self.offsets = {}
+        for _ in range(n_stations):
+            id, _, _, routes, north, south = _STATION.unpack_from(mm, offset)
+            end = offset + _STATION.size + 4 * routes + 17 * (north + south)
+            self.offsets[strings[id]] = (offset, end)
+            offset = end
+
+        self.routes = {}
+        self.route_stations = {}
+        for _ in range(n_routes):
+            id, stops, stations = _ROUTE.unpack_from(mm, offset)
+            offset += _ROUTE.size
+            stop_ids = self._refs(offset, stops)
+            offset += 4 * stops
+            station_ids = self._refs(offset, stations)
+            offset += 4 * stations
+
+            self.routes[strings[id]] = frozenset(stop_ids)
+            self.route_stations[strings[id]] = tuple(station_ids)
+
+        # trip id -> offset of its record
+        self.trip_offsets = {}
+        for _ in range(n_trips):
+            id, _, _, _, stops = _TRIP.unpack_from(mm, offset)
+            self.trip_offsets[strings[id]] = offset
+            offset += _TRIP.size + 12 * stops
+
+    def _refs(self, offset, count):
+        return [ self._strings[ref] for ref in read_array('I', self._mm[offset:offset + 4 * count]) ]
+
+    def _times(self, offset, count):
+        return read_array('q', self._mm[offset:offset + 8 * count])
+
+    def record(self, id):
+        '''The raw bytes of a station's record, for cheap comparison.'''
+        start, end = self.offsets[id]
+        return self._mm[start:end]
+
+    def read_station(self, id):
+        '''Returns (last_update, valid_until, routes, trains) for a station,
+        where trains maps each direction to (times, route_ids, trip_ids,
+        scheduled). Times are epoch seconds or None.'''
+        offset, _ = self.offsets[id]
+        _, last_update, valid_until, routes, north, south = _STATION.unpack_from(self._mm, offset)
+        offset += _STATION.size
+
+        route_ids = self._refs(offset, routes)
+        offset += 4 * routes
+
+        trains = {}
+        for direction, count in (('N', north), ('S', south)):
+            times = self._times(offset, count)
+            offset += 8 * count
+            train_routes = self._refs(offset, count)
+            offset += 4 * count
+            trips = self._refs(offset, count)
+            offset += 4 * count
+            scheduled = array('b')
+            scheduled.frombytes(self._mm[offset:offset + count])
+            offset += count
+            trains[direction] = (times, train_routes, trips, scheduled)
+
+        return (last_update if last_update != _NONE else None,
+                valid_until if valid_until != _NONE else None,
+                route_ids, trains)
+
+    def read_trip(self, id):
+        '''Returns (route, direction, last_update, station_ids, times) for a
+        trip.'''
+        offset = self.trip_offsets[id]
+        _, route, direction, last_update, stops = _TRIP.unpack_from(self._mm, offset)
+        offset += _TRIP.size
+
+        return (self._strings[route], self._strings[direction],
+                last_update if last_update != _NONE else None,
+                self._refs(offset, stops), self._times(offset + 4 * stops, stops))
+
+
+class _SharedStations(Mapping):
+    '''Stations of a _SharedSnapshot, keyed like the reader's own station
+    table. build(base, record) turns a record into a station; stations the
+    snapshot doesn't have are served from base as they are.'''
+
+    def __init__(self, shared, base, build):
+        self._shared = shared
+        self._base = base
+        self._build = build
+        self._cache = {}
+
+    def __getitem__(self, id):
+        try:
+            return self._cache[id]
+        except KeyError:
+            pass
+
+        base = self._base[id]
+        if id in self._shared.offsets:
+            station = self._build(base, self._shared.read_station(id))
+        else:
+            station = base
+
+        self._cache[id] = station
+        return station
+
+    def __iter__(self):
+        return iter(self._base)
+
+    def __len__(self):
+        return len(self._base)
+
+
+class _SharedTrips(Mapping):
+    '''Trips of a _SharedSnapshot. build(id, record) turns a record into a
+    trip.'''
+
+    def __init__(self, shared, build):
+        self._shared = shared
+        self._build = build
+        self._cache = {}
+
+    def __getitem__(self, id):
+        try:
+            return self._cache[id]
+        except KeyError:
+            pass
+
+        trip = self._cache[id] = self._build(id, self._shared.read_trip(id))
+        return trip
+
+    def __iter__(self):
+        return iter(self._shared.trip_offsets)
+
+    def __len__(self):
+        return len(self._shared.trip_offsets)
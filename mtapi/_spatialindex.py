@@ -0,0 +1,138 @@
+import math, heapq
+from collections import defaultdict
+
+
+EARTH_RADIUS = 6371000.0
+
+def distance(p1, p2):
+    '''Equirectangular distance in meters between two (lat, lon) points.
+    Accurate to well under a meter at city scale.'''
+    lat1, lon1 = math.radians(p1[0]), math.radians(p1[1])
+    lat2, lon2 = math.radians(p2[0]), math.radians(p2[1])
+    x = (lon2 - lon1) * math.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return EARTH_RADIUS * math.sqrt(x * x + y * y)
+
+def parse_location(lat, lon, radius=None):
+    '''Validate a query's lat, lon and optional radius, given as numbers or
+    strings. Returns ((lat, lon), radius) as floats. Raises ValueError for
+    anything that isn't a point on Earth and a radius of at least 0 meters.'''
+    point = (float(lat), float(lon))
+    radius = float(radius) if radius is not None else None
+    if not (-90 <= point[0] <= 90 and -180 <= point[1] <= 180):
+        raise ValueError('lat must be within [-90, 90] and lon within [-180, 180]')
+    if radius is not None and not 0 <= radius < math.inf:
+        raise ValueError('radius must be a finite number of meters, at least 0')
+
+    return point, radius
+
+class _SpatialIndex(object):
+    '''Uniform grid over (lat, lon) points for k-nearest queries. Points are
+    bucketed on a plane projected at their mean latitude; returned distances
+    come from distance().'''
+
+    # slack for the difference between the grid projection and distance()
+    PROJECTION_SLACK = 0.99
+
+    def __init__(self, points, cell_size=500):
+        '''points is an iterable of (key, (lat, lon)) pairs. cell_size is in
+        meters.'''
+        points = list(points)
+        self.cell_size = float(cell_size)
+        self._cells = defaultdict(list)
+        self._lat0 = math.radians(sum(p[0] for _, p in points) / len(points)) if points else 0.0
+        self._cos_lat0 = math.cos(self._lat0)
+
+        for key, point in points:
+            xy = self._project(point)
+            self._cells[self._cell(xy)].append((point, key))
+
+        self._finish()
+
+    @classmethod
+    def from_cells(cls, cells, points, cell_size, lat0):
+        '''Rebuild an index from cells(), lat0 and cell_size of an earlier
+        one without reprojecting. points maps each key to its (lat, lon).'''
+        index = cls.__new__(cls)
+        index.cell_size = float(cell_size)
+        index._cells = defaultdict(list)
+        index._lat0 = lat0
+        index._cos_lat0 = math.cos(lat0)
+        for cell, keys in cells.items():
+            index._cells[cell] = [ (points[key], key) for key in keys ]
+
+        index._finish()
+        return index
+
+    def _finish(self):
+        cells = list(self._cells) or [(0, 0)]
+        self._min_cell = (min(c[0] for c in cells), min(c[1] for c in cells))
+        self._max_cell = (max(c[0] for c in cells), max(c[1] for c in cells))
+        self._size = sum(len(points) for points in self._cells.values())
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def lat0(self):
+        '''Latitude of the projection, in radians.'''
+        return self._lat0
+
+    def cells(self):
+        '''cell -> keys in that cell.'''
+        return { cell: [ key for _, key in points ] for cell, points in self._cells.items() }
+
+    def _project(self, point):
+        return (EARTH_RADIUS * math.radians(point[1]) * self._cos_lat0,
+                EARTH_RADIUS * math.radians(point[0]))
+
+    def _cell(self, xy):
+        return (int(math.floor(xy[0] / self.cell_size)), int(math.floor(xy[1] / self.cell_size)))
+
+    def _ring(self, center, r):
+        cx, cy = center
+        if r == 0:
+            yield center
+            return
+
+        for x in range(cx - r, cx + r + 1):
+            yield (x, cy - r)
+            yield (x, cy + r)
+        for y in range(cy - r + 1, cy + r):
+            yield (cx - r, y)
+            yield (cx + r, y)
+
+    def _outside_grid(self, cell):
+        return not (self._min_cell[0] <= cell[0] <= self._max_cell[0] and
+                    self._min_cell[1] <= cell[1] <= self._max_cell[1])
+
+    def nearest(self, point, k=5, radius=None):
+        '''Return up to k (distance, key) pairs closest to point, nearest first.
+        If radius is given only points within radius meters are returned.'''
+        center = self._cell(self._project(point))
+
+        # a query far from every station gains nothing from the grid
+        if self._outside_grid(center):
+            found = [ (distance(point, p), key) for cell in self._cells.values() for p, key in cell ]
+            if radius is not None:
+                found = [ f for f in found if f[0] <= radius ]
+            return heapq.nsmallest(k, found)
+
+        max_ring = max(center[0] - self._min_cell[0], self._max_cell[0] - center[0],
+                       center[1] - self._min_cell[1], self._max_cell[1] - center[1])
+        found = []
+        for r in range(max_ring + 1):
+            for cell in self._ring(center, r):
+                for p, key in self._cells.get(cell, ()):
+                    d = distance(point, p)
+                    if radius is None or d <= radius:
+                        found.append((d, key))
+
+            # anything outside ring r is at least r cells away
+            reach = r * self.cell_size * self.PROJECTION_SLACK
+            if radius is not None and reach >= radius:
+                break
+            if len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= reach:
+                break
+
+        return heapq.nsmallest(k, found)
@@ -1,60 +1,410 @@
-import urllib, contextlib, datetime, copy
+import urllib.request, urllib.error, contextlib, datetime
 from collections import defaultdict
-from itertools import islice
-from operator import itemgetter
-import csv, math, json
-import threading
+from itertools import count
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, wait
+from array import array
+from bisect import bisect_left, bisect_right
+import csv, json
+import asyncio
 import logging
+import heapq
+import os
+import sys
+import threading
+import time
 import google.protobuf.message
-from mtaproto.feedresponse import FeedResponse, Trip, TripStop, TZ
-from mtapi._mtapithreader import _MtapiThreader
+from mtaproto.feedresponse import FeedResponse, TZ, header_timestamp
+from mtapi._mtapischeduler import _MtapiScheduler
+from mtapi._mtapifeed import _MtapiFeed
+from mtapi._spatialindex import _SpatialIndex, parse_location
+from mtapi._mtapipush import _PushBroker
+from mtapi._mtapimetrics import _MtapiMetrics
+from mtapi._mtapishared import _SharedSnapshot, _SharedStations, _SharedTrips, write_snapshot, write_file, file_key
+from mtapi._mtapienvelope import _Envelope
+from mtapi._mtapiarchive import _MtapiArchive
+from mtapi._mtapischedule import _MtapiSchedule
+from mtapi._mtapicatalog import _MtapiCatalog, _line_order, stations_digest
 
 logger = logging.getLogger(__name__)
 
-def distance(p1, p2):
-    return math.sqrt((p2[0] - p1[0])**2 + (p2[1] - p1[1])**2)
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    elif isinstance(obj, (set, frozenset)):
+        return list(obj)
+
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+# C-accelerated encoders for values that are already JSON types
+_ENCODERS = {
+    False: json.JSONEncoder(),
+    True: json.JSONEncoder(separators=(',', ':'))
+}
+
+def _datetime(epoch):
+    return datetime.datetime.fromtimestamp(epoch, TZ)
+
+def _isoformat(epoch):
+    return _datetime(epoch).isoformat()
+
+def render_envelope(rendered, compact=False):
+    '''Join (json, last_update) pairs into the body of a {data, updated}
+    envelope. Returns (body, updated).'''
+    times = [ last_update for _, last_update in rendered if last_update ]
+    time = min(times) if times else None
+
+    body = b''.join([
+        b'{"data":[' if compact else b'{"data": [',
+        (b',' if compact else b', ').join(station_json for station_json, _ in rendered),
+        b'],"updated":' if compact else b'], "updated": ',
+        json.dumps(time.isoformat() if time else None).encode(),
+        b'}'
+    ])
+
+    return body, time
+
+def render_batch(results, compact=False):
+    '''Render the results of Mtapi.get_json_batch as {"results": [...]}, one
+    envelope per query, or an error object for a query that found nothing.'''
+    parts = []
+    for rendered in results:
+        if rendered is None:
+            parts.append(b'{"error":"Station not found"}' if compact else b'{"error": "Station not found"}')
+        else:
+            parts.append(render_envelope(rendered, compact)[0])
+
+    if compact:
+        return b'{"results":[' + b','.join(parts) + b']}'
+
+    return b'{"results": [' + b', '.join(parts) + b']}'
 
 class Mtapi(object):
 
+    class _Arrivals(object):
+        '''Arrivals in one direction at one station, held as parallel arrays of
+        epoch seconds, route ids, trip ids and whether each one comes from the
+        static schedule rather than a realtime feed.'''
+
+        __slots__ = ('times', 'routes', 'trips', 'scheduled', 'labels')
+
+        def __init__(self, times=None, routes=None, trips=None, scheduled=None):
+            self.times = times if times is not None else array('q')
+            self.routes = routes if routes is not None else []
+            self.trips = trips if trips is not None else []
+            self.scheduled = scheduled if scheduled is not None else array('b', bytes(len(self.times)))
+            self.labels = None
+
+        def __len__(self):
+            return len(self.times)
+
+        def __eq__(self, other):
+            return (self.times == other.times and self.routes == other.routes and self.trips == other.trips
+                    and self.scheduled == other.scheduled)
+
+        def append(self, train_time, route_id, trip_id, scheduled=False):
+            self.times.append(train_time)
+            self.routes.append(route_id)
+            self.trips.append(trip_id)
+            self.scheduled.append(scheduled)
+
+        @classmethod
+        def from_heap(cls, heap):
+            '''Build sorted arrivals from a heap of (-time, route_id, trip_id,
+            scheduled) entries.'''
+            heap = sorted(heap, reverse=True)
+            return cls(array('q', [ -entry[0] for entry in heap ]),
+                       [ entry[1] for entry in heap ],
+                       [ entry[2] for entry in heap ],
+                       array('b', [ entry[3] for entry in heap ])).format()
+
+        def format(self):
+            '''Pre-format the times as ISO 8601 strings for JSON output.'''
+            self.labels = [ _isoformat(t) for t in self.times ]
+            return self
+
+        def _end(self, limit, until):
+            '''limit and until (epoch seconds) narrow the output using the time
+            order of the arrays.'''
+            end = len(self.times)
+            if until is not None:
+                end = bisect_right(self.times, until)
+            if limit is not None:
+                end = min(end, limit)
+
+            return end
+
+        def _flag(self, out):
+            '''Mark the scheduled arrivals among the serialized ones.'''
+            if any(self.scheduled):
+                for arrival, scheduled in zip(out, self.scheduled):
+                    if scheduled:
+                        arrival['scheduled'] = True
+
+            return out
+
+        def serialize(self, limit=None, until=None):
+            return self._flag([ {'route': self.routes[i], 'time': datetime.datetime.fromtimestamp(self.times[i], TZ),
+                                 'trip': self.trips[i]}
+                                for i in range(self._end(limit, until)) ])
+
+        def to_json(self, limit=None, until=None):
+            '''Like serialize, but with the times as pre-formatted strings.'''
+            labels = self.labels
+            if labels is None:
+                labels = self.format().labels
+
+            return self._flag([ {'route': self.routes[i], 'time': labels[i], 'trip': self.trips[i]}
+                                for i in range(self._end(limit, until)) ])
+
+    class _Trip(object):
+        '''One train's remaining stops, in order, held as parallel arrays of
+        station ids and epoch seconds.'''
+
+        __slots__ = ('id', 'route', 'direction', 'stations', 'times', 'last_update')
+
+        def __init__(self, id, route, direction, last_update, stations=None, times=None):
+            self.id = id
+            self.route = route
+            self.direction = direction
+            self.last_update = last_update
+            self.stations = stations if stations is not None else []
+            self.times = times if times is not None else array('q')
+
+        def __len__(self):
+            return len(self.times)
+
+        @classmethod
+        def from_record(cls, id, record):
+            '''Rebuild a trip from a _SharedSnapshot record.'''
+            route, direction, last_update, stations, times = record
+            return cls(id, route, direction,
+                       datetime.datetime.fromtimestamp(last_update, TZ) if last_update else None,
+                       stations, times)
+
+        def append(self, station_id, train_time):
+            self.stations.append(station_id)
+            self.times.append(train_time)
+
+        def position(self, now):
+            '''Index of the next stop at epoch second now. Equals len(self) once
+            the train is past every stop the feed listed.'''
+            return bisect_left(self.times, now)
+
+        def _stop(self, stations, i, format):
+            id = self.stations[i]
+            return {'id': id, 'name': stations[id]['name'], 'time': format(self.times[i])}
+
+        def serialize(self, stations, format=None):
+            '''The itinerary, with station names looked up in stations. format
+            turns epoch seconds into output times; by default datetimes.'''
+            format = format or _datetime
+            return {
+                'id': self.id,
+                'route': self.route,
+                'direction': self.direction,
+                'stops': [ self._stop(stations, i, format) for i in range(len(self)) ],
+                'last_update': self.last_update
+            }
+
+        def to_json(self, stations):
+            '''Like serialize, but made only of JSON types.'''
+            out = self.serialize(stations, _isoformat)
+            out['last_update'] = self.last_update.isoformat() if self.last_update else None
+            return out
+
+        def serialize_position(self, stations, now):
+            '''Where the train is at epoch second now: the stop it last passed
+            and the one it is heading to, either of which may be None.'''
+            i = self.position(now)
+            return {
+                'id': self.id,
+                'route': self.route,
+                'direction': self.direction,
+                'previous': self._stop(stations, i - 1, _datetime) if i > 0 else None,
+                'next': self._stop(stations, i, _datetime) if i < len(self) else None,
+                'last_update': self.last_update
+            }
+
     class _Station(object):
         last_update = None
+        valid_until = None
 
-        def __init__(self, json):
+        def __init__(self, json, max_trains=None):
             self.json = json
+            self.max_trains = max_trains
             self.trains = {}
             self.clear_train_data()
 
         def __getitem__(self, key):
             return self.json[key]
 
-        def add_train(self, route_id, direction, train_time, feed_time):
+        def add_train(self, route_id, direction, train_time, feed_time, trip_id=None, scheduled=False):
+            '''Keep the max_trains earliest trains per direction in a bounded
+            max-heap until sort_trains is called. Scheduled trains have no
+            feed_time.'''
             self.routes.add(route_id)
-            self.trains[direction].append({
-                'route': route_id,
-                'time': train_time
-            })
-            self.last_update = feed_time
+            if feed_time:
+                self.last_update = feed_time
+
+            heap = self._heaps[direction]
+            entry = (-train_time, route_id, trip_id, scheduled)
+            if self.max_trains is None or len(heap) < self.max_trains:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
 
         def clear_train_data(self):
-            self.trains['N'] = []
-            self.trains['S'] = []
+            self.trains['N'] = Mtapi._Arrivals()
+            self.trains['S'] = Mtapi._Arrivals()
+            self._heaps = { 'N': [], 'S': [] }
             self.routes = set()
             self.last_update = None
+            self.valid_until = None
+            self._format()
+
+        def _format(self):
+            '''Prepare routes and last_update for JSON output.'''
+            self.route_list = sorted(self.routes)
+            self.last_update_label = self.last_update.isoformat() if self.last_update else None
+
+        def expire_at(self, time):
+            if self.valid_until is None or time < self.valid_until:
+                self.valid_until = time
+
+        def sort_trains(self):
+            for direction, heap in self._heaps.items():
+                self.trains[direction] = Mtapi._Arrivals.from_heap(heap)
+            self._heaps = None
+            self._format()
 
-        def sort_trains(self, max_trains):
-            self.trains['S'] = sorted(self.trains['S'], key=itemgetter('time'))[:max_trains]
-            self.trains['N'] = sorted(self.trains['N'], key=itemgetter('time'))[:max_trains]
+            # the station goes stale once its first train has left
+            for trains in self.trains.values():
+                if trains:
+                    self.expire_at(trains.times[0])
 
-        def serialize(self):
+        @classmethod
+        def from_record(cls, base, record):
+            '''Rebuild a station from a _SharedSnapshot record.'''
+            last_update, valid_until, routes, trains = record
+            station = cls(base.json)
+            for direction, (times, route_ids, trip_ids, scheduled) in trains.items():
+                station.trains[direction] = Mtapi._Arrivals(times, route_ids, trip_ids, scheduled)
+            station.routes = set(routes)
+            station.last_update = datetime.datetime.fromtimestamp(last_update, TZ) if last_update else None
+            station.valid_until = valid_until
+            station._heaps = None
+            station._format()
+
+            return station
+
+        def same_trains(self, other):
+            return self.trains == other.trains and self.routes == other.routes
+
+        def serialize(self, max_trains=None, until=None):
             out = {
-                'N': self.trains['N'],
-                'S': self.trains['S'],
+                'N': self.trains['N'].serialize(max_trains, until),
+                'S': self.trains['S'].serialize(max_trains, until),
                 'routes': self.routes,
                 'last_update': self.last_update
             }
             out.update(self.json)
             return out
 
+        def to_json(self, max_trains=None, until=None):
+            '''Like serialize, but made only of JSON types so the C encoder
+            never has to call back into Python.'''
+            out = {
+                'N': self.trains['N'].to_json(max_trains, until),
+                'S': self.trains['S'].to_json(max_trains, until),
+                'routes': self.route_list,
+                'last_update': self.last_update_label
+            }
+            out.update(self.json)
+            return out
+
+    class _Snapshot(object):
+        '''All the state queries read: a read-only, versioned view of the
+        station table plus the time of the refresh that published it. Updates
+        build a new snapshot and publish it by replacing Mtapi._snapshot;
+        readers grab the reference once and never lock or copy.'''
+
+        __slots__ = ('producer', 'version', 'updated', 'last_update', 'stations', 'routes', 'route_stations',
+                     'trips', 'compact', '_json', '_envelopes')
+
+        # most recent query results kept as whole response bodies
+        MAX_ENVELOPES = 512
+
+        def __init__(self, producer, version, updated, last_update, stations, routes, route_stations, trips,
+                     compact=False):
+            # identifies the process that numbered the versions
+            self.producer = producer
+            self.version = version
+            self.updated = updated
+            self.last_update = last_update
+            self.stations = MappingProxyType(stations)
+            self.routes = MappingProxyType(routes)
+            self.route_stations = MappingProxyType(route_stations)
+            self.trips = MappingProxyType(trips)
+            self.compact = compact
+            self._json = {}
+            self._envelopes = {}
+
+        def refreshed(self, last_update):
+            '''This snapshot as of a later refresh that changed nothing. Shares
+            the data, the version and the JSON cache.'''
+            snapshot = Mtapi._Snapshot.__new__(Mtapi._Snapshot)
+            for name in self.__slots__:
+                setattr(snapshot, name, getattr(self, name))
+            snapshot.last_update = last_update
+
+            return snapshot
+
+        def station_json(self, id, max_trains=None, max_minutes=None):
+            '''Return (json, last_update) for a station. The JSON is rendered
+            once and cached for the life of the snapshot, unless max_trains or
+            max_minutes narrow it.'''
+            encode = _ENCODERS[self.compact].encode
+            if max_trains is not None or max_minutes is not None:
+                station = self.stations[id]
+                until = self.updated + max_minutes * 60 if max_minutes is not None else None
+                return (encode(station.to_json(max_trains, until)).encode(), station.last_update)
+
+            try:
+                return self._json[id]
+            except KeyError:
+                station = self.stations[id]
+                rendered = (encode(station.to_json()).encode(), station.last_update)
+                self._json[id] = rendered
+                return rendered
+
+        def trip_json(self, id):
+            '''Return (json, last_update) for a trip's itinerary, cached like
+            station_json.'''
+            key = ('trip', id)
+            try:
+                return self._json[key]
+            except KeyError:
+                trip = self.trips[id]
+                rendered = (_ENCODERS[self.compact].encode(trip.to_json(self.stations)).encode(), trip.last_update)
+                self._json[key] = rendered
+                return rendered
+
+        def envelope(self, key, render):
+            '''Return the _Envelope for a query, identified by key. render()
+            gives the query's (json, last_update) pairs the first time.'''
+            try:
+                return self._envelopes[key]
+            except KeyError:
+                pass
+
+            envelope = _Envelope(*render_envelope(render(), self.compact))
+            if len(self._envelopes) >= self.MAX_ENVELOPES:
+                self._envelopes.clear()
+            self._envelopes[key] = envelope
+
+            return envelope
+
 
     _FEED_URLS = [
         'https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs',  # 1234567S
@@ -67,33 +417,169 @@ class Mtapi(object):
         'https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-g'  # G
     ]
 
-    def __init__(self, stations_file, expires_seconds=60, max_trains=10, max_minutes=30, threaded=False):
+    # routes each feed carries, for filling in a failed feed from the schedule
+    _FEED_ROUTES = {
+        'gtfs': ('1', '2', '3', '4', '5', '5X', '6', '6X', '7', '7X', 'S'),
+        'gtfs-l': ('L',),
+        'gtfs-nqrw': ('N', 'Q', 'R', 'W'),
+        'gtfs-bdfm': ('B', 'D', 'F', 'FX', 'M'),
+        'gtfs-ace': ('A', 'C', 'E', 'H', 'FS'),
+        'gtfs-si': ('SI',),
+        'gtfs-jz': ('J', 'Z'),
+        'gtfs-g': ('G',)
+    }
+    # how often stations are rebuilt while a feed is filled from the schedule
+    SCHEDULE_REBUILD_SECONDS = 60
+
+    _METRICS = [
+        ('mtapi_update_seconds', 'histogram', 'Time to refresh all due feeds and publish a snapshot.'),
+        ('mtapi_feed_fetch_seconds', 'histogram', 'Time to download a feed.'),
+        ('mtapi_feed_fetch_errors_total', 'counter', 'Feed downloads that failed.'),
+        ('mtapi_feed_deadline_missed_total', 'counter', 'Feed downloads that missed the update deadline.'),
+        ('mtapi_feed_not_modified_total', 'counter', 'Feed downloads answered with 304 Not Modified.'),
+        ('mtapi_feed_unchanged_total', 'counter', 'Feeds skipped because their header timestamp did not move.'),
+        ('mtapi_feed_bytes', 'gauge', 'Size of the last downloaded feed.'),
+        ('mtapi_feed_bytes_total', 'counter', 'Bytes downloaded per feed.'),
+        ('mtapi_feed_decode_seconds', 'histogram', 'Time to parse a feed and extract its arrivals.'),
+        ('mtapi_feed_decode_errors_total', 'counter', 'Feeds that could not be parsed.'),
+        ('mtapi_feed_entities', 'gauge', 'Entities in the last parsed feed.'),
+        ('mtapi_feed_unknown_stops', 'gauge', 'Stop times dropped from the last parsed feed for an unknown stop_id.'),
+        ('mtapi_feed_timestamp_seconds', 'gauge', 'Header timestamp of the last parsed feed.'),
+        ('mtapi_feed_age_seconds', 'gauge', 'Seconds since the header timestamp of the last parsed feed.'),
+        ('mtapi_snapshot_build_seconds', 'histogram', 'Time to rebuild changed stations and swap in a new snapshot.'),
+        ('mtapi_snapshot_stations_rebuilt', 'gauge', 'Stations rebuilt for the current snapshot.'),
+        ('mtapi_snapshot_version', 'gauge', 'Version of the current snapshot.'),
+        ('mtapi_snapshot_age_seconds', 'gauge', 'Seconds since the current snapshot was built.'),
+        ('mtapi_request_seconds', 'histogram', 'Request latency per endpoint.'),
+        ('mtapi_feed_scheduled', 'gauge', '1 while a failed feed is filled in from the static schedule.'),
+        ('mtapi_refresh_coalesced_total', 'counter', 'Queries that found a refresh in flight, by whether they waited or were served stale data.')
+    ]
+
+    def __init__(self, stations_file, expires_seconds=60, max_trains=10, max_minutes=30, threaded=False,
+                 feed_timeout=10, update_deadline=15, feed_intervals=None, autoupdate=True,
+                 shared_file=None, shared_role='producer', state_dir=None, compact_json=False,
+                 stale_seconds=0, archive_dir=None, archive_segment_seconds=3600, schedule_file=None,
+                 schedule_after=300, catalog_file=None):
         self._MAX_TRAINS = max_trains
         self._MAX_MINUTES = max_minutes
         self._EXPIRES_SECONDS = expires_seconds
         self._THREADED = threaded
-        self._stations = {}
+        self._AUTOUPDATE = autoupdate
+        self._FEED_TIMEOUT = feed_timeout
+        self._UPDATE_DEADLINE = update_deadline
+        self._SHARED_FILE = shared_file
+        self._SHARED_READER = shared_file is not None and shared_role == 'reader'
+        self._shared = None
+        # version of the snapshot last written to shared_file
+        self._shared_version = None
+        self._STATE_DIR = state_dir
+        # version of the snapshot last saved to state_dir
+        self._saved_version = None
+        self._COMPACT_JSON = compact_json
+        self._STALE_SECONDS = stale_seconds
+        # readers share the producer's archive but never write to it
+        self.archive = _MtapiArchive(archive_dir, archive_segment_seconds) if archive_dir else None
+        self._RECORD = self.archive is not None and not self._SHARED_READER
+        self.schedule = None
+        self._SCHEDULE_AFTER = schedule_after
+        # routes of the failed feeds currently filled in from the schedule,
+        # and the stations those routes serve
+        self._scheduled_feeds = frozenset()
+        self._scheduled_routes = frozenset()
+        self._scheduled_stations = frozenset()
+        if schedule_file and not self._SHARED_READER:
+            try:
+                self.schedule = _MtapiSchedule(schedule_file)
+            except (OSError, ValueError) as e:
+                logger.error('Couldn\'t load schedule file %s: %s', schedule_file, e)
+        self._flight = None
+        self._flight_lock = threading.Lock()
+        self._restored_feeds = []
+        self._warmup = None
+        self.restored = False
+        self.scheduler = None
         self._stops_to_stations = {}
-        self._routes = {}
-        self._read_lock = threading.RLock()
+        # route_id -> station ids in southbound order, from the static schedule
+        self._static_orders = {}
+        self._versions = count()
+        # versions are only unique per producer, so ETags carry this too
+        self._producer_id = os.urandom(4).hex()
+        self._feeds = [ _MtapiFeed(url, (feed_intervals or {}).get(url, expires_seconds))
+                        for url in self._FEED_URLS ]
+        self._broker = _PushBroker()
+        self.metrics = _MtapiMetrics()
+        for name, type, help in self._METRICS:
+            self.metrics.describe(name, type, help)
+        self._feed_pool = ThreadPoolExecutor(max_workers=len(self._FEED_URLS),
+                                             thread_name_prefix='mtapi-feed')
 
         # initialize the stations database
         try:
-            with open(stations_file, 'r') as f:
-                self._stations = json.load(f)
-                for id in self._stations:
-                    self._stations[id] = self._Station(self._stations[id])
-                self._stops_to_stations = self._build_stops_index(self._stations)
+            with open(stations_file, 'rb') as f:
+                data = f.read()
+                stations = json.loads(data)
+                for id in stations:
+                    stations[id] = self._Station(stations[id])
+
+                catalog = self._load_catalog(catalog_file, data) if catalog_file else None
+                if catalog:
+                    self._stops_to_stations = catalog.stops
+                    self._spatial_index = _SpatialIndex.from_cells(
+                        catalog.cells, { id: stations[id]['location'] for id in stations },
+                        catalog.cell_size, catalog.lat0)
+                    self._static_orders = catalog.routes
+                else:
+                    self._stops_to_stations = self._build_stops_index(stations)
+                    self._spatial_index = _SpatialIndex((id, stations[id]['location']) for id in stations)
+                self._base_stations = MappingProxyType(stations)
+                self._snapshot = self._Snapshot(self._producer_id, next(self._versions), int(time.time()),
+                                                datetime.datetime.now(TZ), stations, {}, {}, {}, compact_json)
 
         except IOError as e:
             print('Couldn\'t load stations file '+stations_file)
             exit()
 
-        self._update()
+        # when the last refresh started; only used to decide when to refresh
+        self._refresh_started = self._snapshot.last_update
+        if self._SHARED_READER:
+            # another process refreshes the feeds; just follow its snapshots
+            self._load_shared()
+            return
+
+        if state_dir:
+            self.restored = self._restore()
+
+        if not autoupdate:
+            return
+        elif not self.restored:
+            self._update()
+        elif not threaded:
+            # serve the saved snapshot while the first refresh runs
+            self._warmup = threading.Thread(target=self._update, name='mtapi-warmup', daemon=True)
+            self._warmup.start()
 
+        # with a restored snapshot every feed is due, so the scheduler's
+        # first pass is the initial refresh
         if threaded:
-            self.threader = _MtapiThreader(self, expires_seconds)
-            self.threader.start_timer()
+            self.scheduler = _MtapiScheduler(self, expires_seconds)
+            self.scheduler.start()
+
+    @staticmethod
+    def _load_catalog(catalog_file, stations_data):
+        '''The station catalog, if it loads and was built from this stations
+        file.'''
+        try:
+            catalog = _MtapiCatalog(catalog_file)
+        except (OSError, ValueError) as e:
+            logger.error('Couldn\'t load catalog file %s: %s', catalog_file, e)
+            return None
+
+        if catalog.digest != stations_digest(stations_data):
+            logger.warning('Catalog file %s was built from a different stations file; ignoring it',
+                           catalog_file)
+            return None
+
+        return catalog
 
     @staticmethod
     def _build_stops_index(stations):
@@ -104,120 +590,818 @@ class Mtapi(object):
 
         return stops
 
-    def _load_mta_feed(self, feed_url):
+    def _load_mta_feed(self, feed):
+        '''Download a feed. Returns the raw protobuf, None if the feed hasn't
+        changed since the last download, or False on error.'''
         try:
-            request = urllib.request.Request(feed_url)
-            with contextlib.closing(urllib.request.urlopen(request)) as r:
+            request = urllib.request.Request(feed.url, headers=feed.request_headers())
+            with contextlib.closing(urllib.request.urlopen(request, timeout=self._FEED_TIMEOUT)) as r:
                 data = r.read()
-                return FeedResponse(data)
+                feed.fetched(r.headers)
+                return data
+
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
 
-        except (urllib.error.URLError, google.protobuf.message.DecodeError, ConnectionResetError) as e:
             logger.error('Couldn\'t connect to MTA server: ' + str(e))
             return False
 
+        except (urllib.error.URLError, ConnectionResetError, TimeoutError) as e:
+            logger.error('Couldn\'t connect to MTA server: ' + str(e))
+            return False
+
+    def _due_feeds(self, now):
+        return [ feed for feed in self._feeds if feed.is_due(now.timestamp()) ]
+
+    def _schedule_feeds(self, results):
+        now = time.time()
+        for feed, data in results:
+            if data is False:
+                feed.backoff(now)
+            else:
+                feed.schedule(now)
+
+    def next_refresh(self):
+        '''Epoch time when the next feed is due, or None if none are
+        scheduled.'''
+        times = [ feed.next_refresh for feed in self._feeds ]
+        return min(times) if times else None
+
+    def _load_mta_feeds(self, feeds):
+        '''Download feeds concurrently. Returns (feed, data) pairs; data is
+        False for a feed that failed or missed the update deadline.'''
+        for feed in feeds:
+            feed.pending = self._feed_pool.submit(self._fetch_feed, feed)
+
+        done, not_done = wait([ feed.pending for feed in feeds ], timeout=self._UPDATE_DEADLINE)
+        return [ (feed, feed.pending.result() if feed.pending in done else self._missed(feed))
+                 for feed in feeds ]
+
+    async def _load_mta_feeds_async(self, feeds):
+        loop = asyncio.get_running_loop()
+        for feed in feeds:
+            feed.pending = loop.run_in_executor(self._feed_pool, self._fetch_feed, feed)
+
+        if feeds:
+            await asyncio.wait([ feed.pending for feed in feeds ], timeout=self._UPDATE_DEADLINE)
+
+        return [ (feed, feed.pending.result() if feed.pending.done() else self._missed(feed))
+                 for feed in feeds ]
+
+    def _fetch_feed(self, feed):
+        '''_load_mta_feed with timing and size metrics.'''
+        started = time.perf_counter()
+        data = self._load_mta_feed(feed)
+        elapsed = time.perf_counter() - started
+
+        self.metrics.observe('mtapi_feed_fetch_seconds', elapsed, feed=feed.name)
+        if data:
+            self.metrics.set('mtapi_feed_bytes', len(data), feed=feed.name)
+            self.metrics.inc('mtapi_feed_bytes_total', len(data), feed=feed.name)
+            logger.info('Feed %s: %d bytes in %.3fs', feed.name, len(data), elapsed)
+        elif data is None:
+            self.metrics.inc('mtapi_feed_not_modified_total', feed=feed.name)
+        else:
+            self.metrics.inc('mtapi_feed_fetch_errors_total', feed=feed.name)
+
+        return data
+
+    def _missed(self, feed):
+        logger.error('Feed %s missed the update deadline', feed.url)
+        self.metrics.inc('mtapi_feed_deadline_missed_total', feed=feed.name)
+        return False
+
+    def _ingest_feeds(self, results, now, record=True):
+        '''Re-extract the feeds whose header timestamp moved, recording them to
+        the archive if there is one. A feed that failed keeps its last good
+        data. Returns the ids of stations that need to be rebuilt.'''
+        touched = set()
+        for feed, data in results:
+            if not data:
+                continue
+
+            timestamp = header_timestamp(data)
+            if timestamp and timestamp == feed.timestamp:
+                feed.commit_validators()
+                self.metrics.inc('mtapi_feed_unchanged_total', feed=feed.name)
+                continue
+
+            started = time.perf_counter()
+            try:
+                mta_data = FeedResponse(data)
+            except google.protobuf.message.DecodeError as e:
+                logger.error('Couldn\'t parse MTA feed %s: %s', feed.url, e)
+                self.metrics.inc('mtapi_feed_decode_errors_total', feed=feed.name)
+                feed.fetched_validators = None
+                continue
+
+            stop_times = mta_data.stop_times(int(now.timestamp()))
+            arrivals, routes, edges, trips, unknown_stops = self._extract_arrivals(mta_data, stop_times, now)
+            touched |= feed.set_data(mta_data.header.timestamp, mta_data.timestamp, arrivals, routes, edges, trips,
+                                     data)
+            feed.commit_validators()
+
+            if record and self._RECORD:
+                try:
+                    self.archive.record(int(now.timestamp()), feed.name, feed.timestamp, data, stop_times)
+                except OSError as e:
+                    logger.error('Couldn\'t archive feed %s: %s', feed.name, e)
+
+            self.metrics.observe('mtapi_feed_decode_seconds', time.perf_counter() - started, feed=feed.name)
+            self.metrics.set('mtapi_feed_entities', len(mta_data.entity), feed=feed.name)
+            self.metrics.set('mtapi_feed_unknown_stops', unknown_stops, feed=feed.name)
+            self.metrics.set('mtapi_feed_timestamp_seconds', feed.timestamp, feed=feed.name)
+
+        return touched
+
+    def _extract_arrivals(self, mta_data, stop_times, now):
+        '''One pass over the feed's stop times. Returns the arrivals at each
+        station, the stops of each route, the order of each route's stations,
+        each trip's remaining stops and the number of unknown stops.'''
+        arrivals = defaultdict(lambda: { 'N': self._Arrivals(), 'S': self._Arrivals() })
+        routes = defaultdict(set)
+        edges = defaultdict(set)
+        trips = {}
+        route_ids = {}
+        unknown_stops = 0
+        stops_to_stations = self._stops_to_stations
+        feed_time = mta_data.timestamp
+        now = int(now.timestamp())
+        max_time = now + self._MAX_MINUTES * 60
+        last_trip = last_station = trip = None
+
+        for trip_id, route_id, direction, stop_id, train_time in stop_times:
+            station_id = stops_to_stations.get(stop_id)
+            if station_id is None:
+                logger.info('Stop %s not found', stop_id)
+                unknown_stops += 1
+                continue
+
+            try:
+                route_id = route_ids[route_id]
+            except KeyError:
+                interned = sys.intern(route_id.upper())
+                route_ids[route_id] = interned
+                route_id = interned
+
+            station_arrivals = arrivals[station_id].get(direction)
+            if station_arrivals is None:
+                continue
+
+            station_arrivals.append(train_time, route_id, trip_id)
+
+            if train_time <= max_time:
+                routes[route_id].add(stop_id)
+
+            if trip_id != last_trip:
+                trip = trips[trip_id] = self._Trip(trip_id, route_id, direction, feed_time)
+            elif station_id != last_station:
+                # consecutive stations of a trip give the order of its line
+                if direction == 'S':
+                    edges[route_id].add((last_station, station_id))
+                else:
+                    edges[route_id].add((station_id, last_station))
+            trip.append(station_id, train_time)
+            last_trip, last_station = trip_id, station_id
+
+        return dict(arrivals), dict(routes), dict(edges), trips, unknown_stops
+
+    def _build_station(self, id, now):
+        now = int(now.timestamp())
+        max_time = now + self._MAX_MINUTES * 60
+        station = self._Station(self._snapshot.stations[id].json, self._MAX_TRAINS)
+
+        for feed in self._feeds:
+            if feed.name in self._scheduled_feeds:
+                # its last good data is too old; the schedule stands in
+                continue
+
+            for direction, arrivals in feed.arrivals.get(id, {}).items():
+                for train_time, route_id, trip_id in zip(arrivals.times, arrivals.routes, arrivals.trips):
+                    if train_time < now:
+                        continue
+                    elif train_time > max_time:
+                        station.expire_at(train_time - self._MAX_MINUTES * 60)
+                    else:
+                        station.add_train(route_id, direction, train_time, feed.updated, trip_id)
+
+        if id in self._scheduled_stations:
+            routes = self._scheduled_routes
+            for stop_id in station['stops']:
+                for route_id, direction, train_time, trip_id in self.schedule.arrivals(stop_id, now, max_time):
+                    if route_id in routes:
+                        station.add_train(route_id, direction, train_time, None, trip_id, scheduled=True)
+
+            # scheduled trains enter the time window without a feed changing
+            station.expire_at(now + self.SCHEDULE_REBUILD_SECONDS)
+
+        station.sort_trains()
+        return station
+
+    def _fill_from_schedule(self, now):
+        '''Decide which feeds to fill in from the static schedule: those that
+        failed their last download and have had no good data for
+        schedule_after seconds. Returns True if that changed.'''
+        if self.schedule is None:
+            return False
+
+        now = now.timestamp()
+        feeds = frozenset(feed.name for feed in self._feeds
+                          if feed.failures and (not feed.timestamp or now - feed.timestamp > self._SCHEDULE_AFTER))
+        for feed in self._feeds:
+            self.metrics.set('mtapi_feed_scheduled', int(feed.name in feeds), feed=feed.name)
+
+        if feeds == self._scheduled_feeds:
+            return False
+
+        if feeds - self._scheduled_feeds:
+            logger.warning('Filling feeds %s from the schedule', ', '.join(sorted(feeds - self._scheduled_feeds)))
+        self._scheduled_feeds = feeds
+        self._scheduled_routes = frozenset(route_id for name in feeds for route_id in self._FEED_ROUTES.get(name, ()))
+        route_stops = self.schedule.route_stops()
+        self._scheduled_stations = frozenset(self._stops_to_stations[stop_id] for route_id in self._scheduled_routes
+                                             for stop_id in route_stops.get(route_id, ())
+                                             if stop_id in self._stops_to_stations)
+        return True
+
     def _update(self):
+        if self._SHARED_READER:
+            self._load_shared()
+            return
+
+        logger.info('updating...')
+        now = self._refresh_started = datetime.datetime.now(TZ)
+
+        started = time.perf_counter()
+        results = self._take_restored_feeds() + self._load_mta_feeds(self._due_feeds(now))
+        self._publish(results, now)
+        self.metrics.observe('mtapi_update_seconds', time.perf_counter() - started)
+
+    async def update_async(self):
+        '''Refresh without blocking the event loop. Downloads and parsing run
+        on worker threads; for use with autoupdate=False.'''
+        if self._SHARED_READER:
+            self._load_shared()
+            return
+
         logger.info('updating...')
-        self._last_update = datetime.datetime.now(TZ)
+        now = self._refresh_started = datetime.datetime.now(TZ)
+
+        started = time.perf_counter()
+        results = self._take_restored_feeds() + await self._load_mta_feeds_async(self._due_feeds(now))
+        await asyncio.get_running_loop().run_in_executor(None, self._publish, results, now)
+        self.metrics.observe('mtapi_update_seconds', time.perf_counter() - started)
 
-        # create working copy for thread safety
-        stations = copy.deepcopy(self._stations)
+    def _publish(self, results, now, record=True):
+        snapshot = self._snapshot
+        dirty = self._ingest_feeds(results, now, record)
+        self._schedule_feeds(results)
+        if self._fill_from_schedule(now):
+            dirty.update(snapshot.stations)
 
-        # clear old times
-        for id in stations:
-            stations[id].clear_train_data()
+        # stations whose trains have left or entered the time window
+        for id, station in snapshot.stations.items():
+            if station.valid_until and station.valid_until <= now.timestamp():
+                dirty.add(id)
 
         routes = defaultdict(set)
+        for feed in self._feeds:
+            if feed.name in self._scheduled_feeds:
+                continue
+            for route_id, stop_ids in feed.routes.items():
+                routes[route_id] |= stop_ids
+        # routes filled in from the schedule serve their scheduled stops
+        if self._scheduled_routes:
+            route_stops = self.schedule.route_stops()
+            for route_id in self._scheduled_routes:
+                stop_ids = route_stops.get(route_id, frozenset()) & self._stops_to_stations.keys()
+                if stop_ids:
+                    routes[route_id] |= stop_ids
+        routes = { route_id: frozenset(stop_ids) for route_id, stop_ids in routes.items() }
+
+        if not dirty and routes == snapshot.routes:
+            self._snapshot = snapshot.refreshed(now)
+        else:
+            # rebuild only the stations touched by changed feeds
+            started = time.perf_counter()
+            stations = dict(snapshot.stations)
+            for id in dirty:
+                stations[id] = self._build_station(id, now)
+
+            trips = {}
+            for feed in self._feeds:
+                if feed.name not in self._scheduled_feeds:
+                    trips.update(feed.trips)
+
+            self._snapshot = self._Snapshot(self._producer_id, next(self._versions), int(now.timestamp()), now,
+                                            stations, routes, self._order_routes(stations, routes), trips,
+                                            self._COMPACT_JSON)
+
+            self.metrics.observe('mtapi_snapshot_build_seconds', time.perf_counter() - started)
+            self.metrics.set('mtapi_snapshot_stations_rebuilt', len(dirty))
+            self.metrics.set('mtapi_snapshot_version', self._snapshot.version)
+
+            self._broker.publish(snapshot, self._snapshot, dirty)
+
+        # a refresh that changed nothing leaves the file alone, so readers
+        # keep their decoded stations and rendered JSON
+        if self._SHARED_FILE and self._snapshot.version != self._shared_version:
+            try:
+                write_snapshot(self._SHARED_FILE, self._snapshot, next_refresh=self.next_refresh())
+                self._shared_version = self._snapshot.version
+            except OSError as e:
+                logger.error('Couldn\'t write shared snapshot: ' + str(e))
+
+        if self._STATE_DIR:
+            self._save_state()
+
+    def _state_path(self, name):
+        return os.path.join(self._STATE_DIR, name)
+
+    def _save_state(self):
+        '''Save the current snapshot, and the raw feeds it was built from, to
+        state_dir. Both are only rewritten when they change; a refresh that
+        changed nothing just touches the snapshot, whose mtime is then the
+        time of the last refresh.'''
+        try:
+            for feed in self._feeds:
+                if feed.raw and feed.timestamp != feed.saved_timestamp:
+                    write_file(self._state_path(feed.name + '.pb'), feed.raw, fsync=True)
+                    feed.saved_timestamp = feed.timestamp
+
+            path = self._state_path('snapshot')
+            if self._snapshot.version != self._saved_version:
+                write_snapshot(path, self._snapshot, fsync=True)
+                self._saved_version = self._snapshot.version
+            else:
+                last_update = self._snapshot.last_update.timestamp()
+                os.utime(path, (last_update, last_update))
+        except OSError as e:
+            logger.error('Couldn\'t save state: ' + str(e))
+
+    def _restore(self):
+        '''Load the snapshot and feeds saved in state_dir. The snapshot is
+        served as is; the feeds are re-ingested by the next refresh so a feed
+        that fails then still has its last good data.'''
+        try:
+            shared = _SharedSnapshot(self._state_path('snapshot'))
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.error('Couldn\'t restore saved snapshot: ' + str(e))
+            return False
 
-        for i, feed_url in enumerate(self._FEED_URLS):
-            mta_data = self._load_mta_feed(feed_url)
+        self._snapshot = self._shared_snapshot(shared)
+        # refreshes after the snapshot was written only touched the file
+        mtime = shared.key[1] / 1e9
+        if mtime > shared.last_update:
+            self._snapshot = self._snapshot.refreshed(datetime.datetime.fromtimestamp(mtime, TZ))
+        self._saved_version = shared.version
+        self._versions = count(shared.version + 1)
+        self._refresh_started = self._snapshot.last_update
 
-            if not mta_data:
+        for feed in self._feeds:
+            try:
+                with open(self._state_path(feed.name + '.pb'), 'rb') as f:
+                    data = f.read()
+            except OSError:
                 continue
 
-            max_time = self._last_update + datetime.timedelta(minutes = self._MAX_MINUTES)
+            feed.saved_timestamp = header_timestamp(data)
+            self._restored_feeds.append((feed, data))
 
-            for entity in mta_data.entity:
-                trip = Trip(entity)
+        logger.info('Restored snapshot %d from %d seconds ago', shared.version, time.time() - shared.updated)
+        return True
 
-                if not trip.is_valid():
-                    continue
+    def _take_restored_feeds(self):
+        results, self._restored_feeds = self._restored_feeds, []
+        return results
 
-                direction = trip.direction[0]
-                route_id = trip.route_id.upper()
+    def _shared_changed(self):
+        try:
+            return file_key(self._SHARED_FILE) != (self._shared.key if self._shared else None)
+        except OSError:
+            return False
 
-                for update in entity.trip_update.stop_time_update:
-                    trip_stop = TripStop(update)
+    def _load_shared(self):
+        '''Swap in the snapshot a producer process last wrote to shared_file,
+        if it has changed.'''
+        if not self._shared_changed():
+            return
 
-                    if trip_stop.time < self._last_update or trip_stop.time > max_time:
-                        continue
+        try:
+            shared = _SharedSnapshot(self._SHARED_FILE)
+        except (OSError, ValueError) as e:
+            logger.error('Couldn\'t read shared snapshot: ' + str(e))
+            return
 
-                    stop_id = trip_stop.stop_id
+        snapshot = self._snapshot
+        if self._shared and (shared.producer, shared.version) == (snapshot.producer, snapshot.version):
+            # the same data rewritten; keep what this process decoded and
+            # rendered from it
+            self._snapshot = snapshot.refreshed(datetime.datetime.fromtimestamp(shared.last_update, TZ))
+        else:
+            self._snapshot = self._shared_snapshot(shared)
+        self._refresh_started = self._snapshot.last_update
+        old, self._shared = self._shared, shared
 
-                    if stop_id not in self._stops_to_stations:
-                        logger.info('Stop %s not found', stop_id)
-                        continue
+        if len(self._broker):
+            base = self._base_stations
+            dirty = { id for id in shared.offsets if id in base and
+                      (old is None or id not in old.offsets or old.record(id) != shared.record(id)) }
+            self._broker.publish(snapshot, self._snapshot, dirty)
 
-                    station_id = self._stops_to_stations[stop_id]
-                    stations[station_id].add_train(route_id,
-                                                   direction,
-                                                   trip_stop.time,
-                                                   mta_data.timestamp)
+    def _shared_snapshot(self, shared):
+        base = self._base_stations
+        route_stations = { route_id: tuple(id for id in ids if id in base)
+                           for route_id, ids in shared.route_stations.items() }
 
-                    routes[route_id].add(stop_id)
+        return self._Snapshot(shared.producer, shared.version, shared.updated,
+                              datetime.datetime.fromtimestamp(shared.last_update, TZ),
+                              _SharedStations(shared, base, self._Station.from_record),
+                              shared.routes, route_stations, _SharedTrips(shared, self._Trip.from_record),
+                              self._COMPACT_JSON)
 
+    def _order_routes(self, stations, routes):
+        '''Each route's stations, once each, in southbound line order as seen
+        in the feeds' trips, then in the static schedule's. Stations neither
+        orders fall back to name order.'''
+        edges = defaultdict(set)
+        for route_id, ids in self._static_orders.items():
+            edges[route_id].update(zip(ids, ids[1:]))
+        for feed in self._feeds:
+            for route_id, route_edges in feed.edges.items():
+                edges[route_id] |= route_edges
 
-        # sort by time
-        for id in stations:
-            stations[id].sort_trains(self._MAX_TRAINS)
+        route_stations = {}
+        for route_id, stop_ids in routes.items():
+            ids = { self._stops_to_stations[k] for k in stop_ids }
+            route_stations[route_id] = tuple(_line_order(ids, edges.get(route_id, ()),
+                                                         lambda id: stations[id]['name']))
 
-        with self._read_lock:
-            self._routes = routes
-            self._stations = stations
+        return route_stations
 
     def last_update(self):
-        return self._last_update
+        return self._snapshot.last_update
 
-    def get_by_point(self, point, limit=5):
-        if self.is_expired():
-            self._update()
+    def snapshot(self):
+        '''The current snapshot. Callers that read several things, e.g. routes
+        and last_update, should read them from one snapshot so they agree.'''
+        self._refresh_if_expired()
+
+        return self._snapshot
+
+    def version(self):
+        '''Version of the current snapshot. Changes only when the data does.'''
+        self._refresh_if_expired()
 
-        with self._read_lock:
-            sortable_stations = copy.deepcopy(self._stations).values()
+        return self._snapshot.version
 
-        sorted_stations = sorted(sortable_stations, key=lambda s: distance(s['location'], point))
-        serialized_stations = map(lambda s: s.serialize(), sorted_stations)
+    def seconds_until_update(self):
+        '''Seconds the current data can be cached for, or None.'''
+        if not self._EXPIRES_SECONDS:
+            return None
 
-        return list(islice(serialized_stations, limit))
+        if self._SHARED_READER:
+            # the updater's schedule, as of the last snapshot it wrote
+            next_refresh = self._shared.next_refresh if self._shared else None
+        elif self.scheduler or not self._AUTOUPDATE:
+            # refreshed whenever the next feed is due
+            next_refresh = self.next_refresh()
+        else:
+            age = datetime.datetime.now(TZ) - self._refresh_started
+            return max(0, self._EXPIRES_SECONDS - age.total_seconds())
+
+        if next_refresh is None:
+            return 0
+
+        return min(max(0, next_refresh - time.time()), self._EXPIRES_SECONDS)
+
+    def get_by_point(self, point, limit=5, radius=None):
+        self._refresh_if_expired()
+
+        stations = self._snapshot.stations
+        nearest = self._spatial_index.nearest(point, limit, radius)
+
+        return [ stations[id].serialize() for _, id in nearest ]
 
     def get_routes(self):
-        return self._routes.keys()
+        return self._snapshot.routes.keys()
 
     def get_by_route(self, route):
         route = route.upper()
 
-        if self.is_expired():
-            self._update()
+        self._refresh_if_expired()
 
-        with self._read_lock:
-            out = [ self._stations[self._stops_to_stations[k]].serialize() for k in self._routes[route] ]
-
-        out.sort(key=lambda x: x['name'])
-        return out
+        snapshot = self._snapshot
+        return [ snapshot.stations[k].serialize() for k in snapshot.route_stations[route] ]
 
     def get_by_id(self, ids):
-        if self.is_expired():
-            self._update()
+        self._refresh_if_expired()
 
-        with self._read_lock:
-            out = [ self._stations[k].serialize() for k in ids ]
+        snapshot = self._snapshot
+        out = [ snapshot.stations[k].serialize() for k in ids ]
 
         return out
 
+    def get_envelope_by_point(self, point, limit=5, radius=None, max_trains=None, max_minutes=None):
+        '''Like get_by_point, but returns the whole response as an _Envelope,
+        rendered and compressed once per snapshot.'''
+        self._refresh_if_expired()
+
+        snapshot = self._snapshot
+        limits = self._limits(max_trains, max_minutes)
+        # nearby points mostly find the same stations, so cache by those;
+        # the body is the same as /by-id's for them
+        ids = tuple(id for _, id in self._spatial_index.nearest(point, limit, radius))
+
+        return snapshot.envelope(('id', ids, limits), lambda: [ snapshot.station_json(id, *limits) for id in ids ])
+
+    def get_envelope_by_route(self, route, max_trains=None, max_minutes=None):
+        route = route.upper()
+
+        self._refresh_if_expired()
+
+        snapshot = self._snapshot
+        limits = self._limits(max_trains, max_minutes)
+
+        def render():
+            return [ snapshot.station_json(k, *limits) for k in snapshot.route_stations[route] ]
+
+        return snapshot.envelope(('route', route, limits), render)
+
+    def get_envelope_by_id(self, ids, max_trains=None, max_minutes=None):
+        self._refresh_if_expired()
+
+        snapshot = self._snapshot
+        limits = self._limits(max_trains, max_minutes)
+
+        def render():
+            return [ snapshot.station_json(k, *limits) for k in ids ]
+
+        return snapshot.envelope(('id', tuple(ids), limits), render)
+
+    def get_by_trip(self, ids):
+        '''The remaining stops of each trip, in order. Raises KeyError for a
+        trip that isn't in the current feeds.'''
+        self._refresh_if_expired()
+
+        snapshot = self._snapshot
+        return [ snapshot.trips[id].serialize(snapshot.stations) for id in ids ]
+
+    def get_envelope_by_trip(self, ids):
+        self._refresh_if_expired()
+
+        snapshot = self._snapshot
+        return snapshot.envelope(('trip', tuple(ids)), lambda: [ snapshot.trip_json(id) for id in ids ])
+
+    def get_trip_positions(self, ids):
+        '''Where each trip is now: the stop it last passed and the one it is
+        heading to.'''
+        self._refresh_if_expired()
+
+        snapshot = self._snapshot
+        now = time.time()
+        return [ snapshot.trips[id].serialize_position(snapshot.stations, now) for id in ids ]
+
+    def replay(self, since, until=None, speed=None, archive=None):
+        '''Feed the feeds recorded between since and until (epoch seconds)
+        back through the normal ingest path, in order, as if each was just
+        downloaded at the time it was recorded. Yields the snapshot after each
+        one. speed, if given, paces the replay at that many times real time;
+        otherwise it runs as fast as it can. Replayed feeds are not recorded
+        again. For use with autoupdate=False.'''
+        archive = archive or self.archive
+        feeds = { feed.name: feed for feed in self._feeds }
+        last = None
+
+        for recorded, name, raw in archive.feeds(since, until if until is not None else time.time()):
+            feed = feeds.get(name)
+            if feed is None:
+                continue
+
+            if speed and last is not None:
+                time.sleep(max(0, recorded - last) / speed)
+            last = recorded
+
+            self._publish([(feed, raw)], datetime.datetime.fromtimestamp(recorded, TZ), record=False)
+            yield self._snapshot
+
+    def get_history_by_id(self, ids, at):
+        '''Stations as they were at epoch second at, rebuilt from the archive.
+        Only the archived feeds current at that time are read, and only the
+        rows for these stations. Raises KeyError for an unknown station.'''
+        stations = [ self._base_stations[id] for id in ids ]
+        extracts = self.archive.extracts_at(at)
+        history = self._history(at, extracts, set(ids))
+
+        return [ history.get(id, station).serialize() for id, station in zip(ids, stations) ]
+
+    def get_history_by_route(self, route, at):
+        '''Every station the route served at epoch second at, rebuilt from the
+        archive, in the route's current line order. Raises KeyError if the route
+        had no trains then.'''
+        route = route.upper()
+        extracts = self.archive.extracts_at(at)
+        max_time = at + self._MAX_MINUTES * 60
+
+        ids = set()
+        for _, _, _, extract in extracts:
+            for _, _, _, stop_id, train_time in extract.on_route(route):
+                if at <= train_time <= max_time and stop_id in self._stops_to_stations:
+                    ids.add(self._stops_to_stations[stop_id])
+        if not ids:
+            raise KeyError(route)
+
+        history = self._history(at, extracts, ids)
+        order = { id: i for i, id in enumerate(self._snapshot.route_stations.get(route, ())) }
+        ids = sorted(ids, key=lambda id: (order.get(id, len(order)), self._base_stations[id]['name']))
+
+        return [ history[id].serialize() for id in ids ]
+
+    def _history(self, at, extracts, ids):
+        '''Rebuild the given stations from archived extracts as of epoch
+        second at, the way _build_station does from live feeds.'''
+        max_time = at + self._MAX_MINUTES * 60
+        stations = {}
+
+        for _, _, timestamp, extract in extracts:
+            feed_time = datetime.datetime.fromtimestamp(timestamp, TZ) if timestamp else None
+            for id in ids:
+                for stop_id in self._base_stations[id]['stops']:
+                    for trip_id, route_id, direction, _, train_time in extract.at_stop(stop_id):
+                        if not at <= train_time <= max_time:
+                            continue
+
+                        station = stations.get(id)
+                        if station is None:
+                            station = stations[id] = self._Station(self._base_stations[id].json, self._MAX_TRAINS)
+                        station.add_train(route_id.upper(), direction, train_time, feed_time, trip_id)
+
+        for station in stations.values():
+            station.sort_trains()
+
+        return stations
+
+    def _limits(self, max_trains, max_minutes):
+        '''Clamp per-request limits to the configured ones. A limit that
+        doesn't narrow the stored data becomes None.'''
+        if max_trains is not None:
+            max_trains = max(0, max_trains)
+            if max_trains >= self._MAX_TRAINS:
+                max_trains = None
+
+        if max_minutes is not None:
+            max_minutes = max(0, max_minutes)
+            if max_minutes >= self._MAX_MINUTES:
+                max_minutes = None
+
+        return max_trains, max_minutes
+
+    def get_json_batch(self, queries):
+        '''Answer several queries from one snapshot. Each query is a dict:
+        {'by': 'id', 'ids': [...]}, {'by': 'route', 'route': ...} or
+        {'by': 'location', 'lat': ..., 'lon': ..., 'radius': ...}, each with
+        optional 'max_trains' and 'max_minutes'. Returns a list of
+        (json, last_update) pairs per query, or None for a query naming an
+        unknown station or route. A station is rendered once no matter how many
+        queries include it. Raises ValueError for a malformed query.'''
+        plans = [ self._parse_query(n, query) for n, query in enumerate(queries) ]
+
+        snapshot = self.snapshot()
+        rendered = {}
+
+        def render(id, limits):
+            key = (id, limits)
+            try:
+                return rendered[key]
+            except KeyError:
+                result = rendered[key] = snapshot.station_json(id, *limits)
+                return result
+
+        results = []
+        for by, arg, limits in plans:
+            try:
+                if by == 'id':
+                    ids = arg
+                elif by == 'route':
+                    ids = snapshot.route_stations[arg]
+                else:
+                    ids = [ id for _, id in self._spatial_index.nearest(arg[0], 5, arg[1]) ]
+
+                results.append([ render(id, limits) for id in ids ])
+            except KeyError:
+                results.append(None)
+
+        return results
+
+    def _parse_query(self, n, query):
+        try:
+            by = query['by']
+            limits = self._limits(
+                int(query['max_trains']) if query.get('max_trains') is not None else None,
+                int(query['max_minutes']) if query.get('max_minutes') is not None else None)
+
+            if by == 'id':
+                if isinstance(query['ids'], str) or not all(isinstance(id, str) for id in query['ids']):
+                    raise TypeError('ids must be a list of strings')
+                return by, list(query['ids']), limits
+            elif by == 'route':
+                return by, str(query['route']).upper(), limits
+            elif by == 'location':
+                return by, parse_location(query['lat'], query['lon'], query.get('radius')), limits
+
+            raise ValueError('unknown query type %r' % (by,))
+        except (KeyError, TypeError, ValueError, OverflowError, AttributeError) as e:
+            raise ValueError('Query %d: %s' % (n, 'missing ' + str(e) if isinstance(e, KeyError) else e))
+
+    def subscribe(self, station_ids=(), routes=(), on_change=None):
+        '''Subscribe to changes at the given stations and at every station on
+        the given routes. on_change, if given, is called from the updating
+        thread whenever the subscription has news. Raises KeyError for an
+        unknown station id.'''
+        snapshot = self._snapshot
+        for id in station_ids:
+            snapshot.stations[id]
+
+        return self._broker.subscribe(snapshot, station_ids, routes, on_change)
+
+    def get_json_by_subscription(self, subscription, ids=None):
+        '''Render the stations of a subscription, or just ids if given, from
+        the current snapshot.'''
+        snapshot = self._snapshot
+        if ids is None:
+            ids = subscription.resolve(snapshot)
+
+        return [ snapshot.station_json(id) for id in sorted(ids) ]
+
+    def render_metrics(self):
+        '''All metrics in the Prometheus text format.'''
+        now = time.time()
+        self.metrics.set('mtapi_snapshot_age_seconds', now - self._snapshot.updated)
+        for feed in self._feeds:
+            if feed.timestamp:
+                self.metrics.set('mtapi_feed_age_seconds', now - feed.timestamp, feed=feed.name)
+
+        return self.metrics.render()
+
+    def stop(self):
+        '''Stop background refreshing.'''
+        if self.scheduler:
+            self.scheduler.stop()
+
+    def _refresh_if_expired(self):
+        '''Refresh inline if the data has expired. Only one refresh runs at a
+        time: queries that arrive while it is in flight wait for it, or, while
+        the data is less than stale_seconds past expiry, go on with the current
+        snapshot.'''
+        # the common case, fresh data and nothing in flight, takes no lock
+        if self._flight is None and not self.is_expired():
+            return
+
+        with self._flight_lock:
+            flight = self._flight
+            if flight is None:
+                if not self.is_expired():
+                    return
+                flight = self._flight = threading.Event()
+                leader = True
+            else:
+                leader = False
+
+        if leader:
+            try:
+                self._update()
+            finally:
+                with self._flight_lock:
+                    self._flight = None
+                flight.set()
+        elif self._serve_stale():
+            self.metrics.inc('mtapi_refresh_coalesced_total', outcome='stale')
+        else:
+            self.metrics.inc('mtapi_refresh_coalesced_total', outcome='waited')
+            flight.wait()
+
+    def _serve_stale(self):
+        if not self._STALE_SECONDS or self._SHARED_READER:
+            return False
+
+        age = datetime.datetime.now(TZ) - self._snapshot.last_update
+        return age.total_seconds() <= self._EXPIRES_SECONDS + self._STALE_SECONDS
+
     def is_expired(self):
-        if self._THREADED and self.threader and self.threader.restart_if_dead():
+        if self._SHARED_READER:
+            return self._shared_changed()
+        elif not self._AUTOUPDATE:
+            return False
+        elif self._warmup and self._warmup.is_alive():
+            return False
+        elif self.scheduler:
+            # the scheduler thread does all refreshing
             return False
         elif self._EXPIRES_SECONDS:
-            age = datetime.datetime.now(TZ) - self._last_update
+            age = datetime.datetime.now(TZ) - self._refresh_started
             return age.total_seconds() > self._EXPIRES_SECONDS
         else:
             return False
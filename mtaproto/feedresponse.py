@@ -1,15 +1,76 @@
 from mtaproto import nyct_subway_pb2
 from pytz import timezone
 import datetime
+import google.protobuf.message
 
 TZ = timezone('US/Eastern')
 
+# NyctTripDescriptor.Direction value -> 'N', 'E', 'S' or 'W'
+_DIRECTIONS = { value: name[0] for name, value in nyct_subway_pb2.NyctTripDescriptor.Direction.items() }
+
+def header_timestamp(response_string):
+    '''Read FeedMessage.header.timestamp without parsing the feed entities.
+    Returns None if the header isn't the first field of the message.'''
+
+    # field 1 (header), wire type 2 (length-delimited)
+    if not response_string or response_string[0] != 0x0a:
+        return None
+
+    length, shift, pos = 0, 0, 1
+    while pos < len(response_string):
+        byte = response_string[pos]
+        length |= (byte & 0x7f) << shift
+        shift += 7
+        pos += 1
+        if not byte & 0x80:
+            break
+
+    header = nyct_subway_pb2.gtfs__realtime__pb2.FeedHeader()
+    try:
+        header.ParseFromString(response_string[pos:pos + length])
+    except google.protobuf.message.DecodeError:
+        return None
+
+    return header.timestamp
+
+
 class FeedResponse(object):
 
     def __init__(self, response_string):
         self._pb_data = nyct_subway_pb2.gtfs__realtime__pb2.FeedMessage()
         self._pb_data.ParseFromString(response_string)
 
+    def stop_times(self, min_time=0):
+        '''Flatten every trip update into (trip_id, route_id, direction,
+        stop_id, epoch) tuples in trip order, skipping stop times before
+        min_time (epoch seconds). This reads the protobuf directly rather than
+        through Trip and TripStop.'''
+        out = []
+        append = out.append
+        nyct_trip_descriptor = nyct_subway_pb2.nyct_trip_descriptor
+
+        for entity in self._pb_data.entity:
+            if not entity.HasField('trip_update'):
+                continue
+
+            trip_update = entity.trip_update
+            trip = trip_update.trip
+            direction = _DIRECTIONS.get(trip.Extensions[nyct_trip_descriptor].direction)
+            if direction is None:
+                continue
+
+            trip_id = trip.trip_id
+            route_id = trip.route_id
+            if route_id == 'GS':
+                route_id = 'S'
+
+            for update in trip_update.stop_time_update:
+                epoch = update.arrival.time or update.departure.time
+                if epoch >= min_time:
+                    append((trip_id, route_id, direction, update.stop_id[:3], epoch))
+
+        return out
+
     def __getattr__(self, name):
 
         if name == 'timestamp':
@@ -51,8 +112,9 @@ class TripStop(object):
     def __getattr__(self, name):
 
         if name == 'time':
-            raw_time = self._pb_data.arrival.time or self._pb_data.departure.time
-            return datetime.datetime.fromtimestamp(raw_time, TZ)
+            return datetime.datetime.fromtimestamp(self.epoch, TZ)
+        elif name == 'epoch':
+            return self._pb_data.arrival.time or self._pb_data.departure.time
         elif name == 'stop_id':
             return str(self._pb_data.stop_id[:3])
 
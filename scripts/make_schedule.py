@@ -0,0 +1,26 @@
+# Given a directory holding the MTA's static GTFS files (trips.txt, stop_times.txt, calendar.txt and
+# calendar_dates.txt), creates the schedule index read by Mtapi's schedule_file option.
+# Rebuild it whenever the MTA publishes a new schedule.
+
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mtapi._mtapischedule import build_schedule
+from mtapi._mtapishared import write_file
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a schedule index from static GTFS files.')
+    parser.add_argument('gtfs_dir')
+    parser.add_argument('output_file')
+    args = parser.parse_args()
+
+    started = time.time()
+    data = build_schedule(args.gtfs_dir)
+    write_file(args.output_file, data)
+
+    print('%s: %d bytes in %.1fs' % (args.output_file, len(data), time.time() - started))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# Given a directory holding the MTA's static GTFS files (stops.txt, transfers.txt, trips.txt and
+# stop_times.txt), groups the stops into stations and writes stations.json, plus the station catalog
+# read by Mtapi's catalog_file option. After editing stations.json by hand, pass it with --stations
+# to rebuild just the catalog; Mtapi ignores a catalog built from a different stations file.
+
+import argparse, json, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mtapi._mtapicatalog import build_stations, route_orders, encode_catalog, stations_digest
+from mtapi._mtapishared import write_file
+from mtapi._spatialindex import _SpatialIndex
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate stations JSON and catalog files from static GTFS files.')
+    parser.add_argument('gtfs_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--stations', help='an edited stations.json to build the catalog for')
+    args = parser.parse_args()
+
+    started = time.time()
+    stations_file = os.path.join(args.output_dir, 'stations.json')
+    if args.stations:
+        with open(args.stations, 'rb') as f:
+            data = f.read()
+        stations = json.loads(data)
+    else:
+        stations = build_stations(args.gtfs_dir)
+        data = json.dumps(stations, sort_keys=True, indent=4, separators=(',', ': ')).encode()
+        write_file(stations_file, data)
+        print('%s: %d stations' % (stations_file, len(stations)))
+
+    routes = route_orders(args.gtfs_dir, stations)
+    index = _SpatialIndex((id, stations[id]['location']) for id in stations)
+    catalog_file = os.path.join(args.output_dir, 'stations.catalog')
+    catalog = encode_catalog(stations, routes, stations_digest(data), index)
+    write_file(catalog_file, catalog)
+
+    print('%s: %d bytes, %d routes in %.1fs' % (catalog_file, len(catalog), len(routes), time.time() - started))
+
+
+if __name__ == '__main__':
+    main()
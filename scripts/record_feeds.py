@@ -0,0 +1,30 @@
+# Saves the current MTA feeds to a directory for benchmarks/bench.py --fixtures.
+# Run it a few times of day (rush hour, midday, overnight) to build a fixture set.
+
+import argparse, contextlib, os, sys, urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mtapi import Mtapi
+from benchmarks.fixtures import recorded_feed_name
+
+def main():
+    parser = argparse.ArgumentParser(description='Record MTA realtime feeds to disk.')
+    parser.add_argument('output_dir')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for url in Mtapi._FEED_URLS:
+        with contextlib.closing(urllib.request.urlopen(url, timeout=30)) as r:
+            data = r.read()
+
+        path = os.path.join(args.output_dir, recorded_feed_name(url))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        print('%s: %d bytes' % (path, len(data)))
+
+
+if __name__ == '__main__':
+    main()
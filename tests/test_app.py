@@ -0,0 +1,199 @@
+import json, time
+import app
+from benchmarks.fixtures import make_feed, ReplayMtapi
+from mtapi import Mtapi
+from mtapi.mtapi import _json_default
+from mtapi._mtapienvelope import snapshot_etag
+
+
+def test_by_route_matches_envelope(client):
+    client, feeds = client
+    resp = client.get('/by-route/1')
+
+    expected = json.dumps(app._make_envelope(app.mta.get_by_route('1')), default=_json_default)
+    assert resp.status_code == 200
+    assert resp.data == expected.encode()
+
+def test_by_id(client):
+    client, feeds = client
+    data = client.get('/by-id/103,101').get_json()['data']
+
+    assert [ s['id'] for s in data ] == ['103', '101']
+    assert data[1]['S'][0]['route'] == '1'
+    assert client.get('/by-id/nope').status_code == 404
+
+def test_by_location(client):
+    client, feeds = client
+    data = client.get('/by-location?lat=40.889248&lon=-73.898583').get_json()['data']
+
+    assert data[0]['id'] == '101'
+    assert len(data) == 5
+
+    for query in ('lat=nan&lon=-73.9', 'lat=inf&lon=-73.9', 'lat=40.8&lon=-73.9&radius=nan', 'lat=x&lon=-73.9',
+                  'lat=1e308&lon=1e308', 'lat=91&lon=-73.9', 'lat=40.8&lon=-181', 'lat=40.8&lon=-73.9&radius=-1'):
+        assert client.get('/by-location?' + query).status_code == 400
+
+def test_etag_and_304(client):
+    client, feeds = client
+    resp = client.get('/by-route/1')
+    etag = resp.headers['ETag']
+
+    assert resp.headers['Last-Modified']
+    assert 'max-age' in resp.headers['Cache-Control']
+
+    resp = client.get('/by-route/1', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == b''
+
+    url = app.mta._FEED_URLS[0]
+    feeds[url] = make_feed([('t3', '1', 'NORTH', [('101N', time.time() + 300)])], timestamp=time.time() + 30)
+    app.mta._update()
+    resp = client.get('/by-route/1', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+def test_stream(client):
+    client, feeds = client
+    resp = client.get('/stream?ids=101', buffered=False)
+
+    assert resp.mimetype == 'text/event-stream'
+    event = next(resp.response)
+    assert event.startswith(b'data: ')
+    assert json.loads(event[6:])['data'][0]['id'] == '101'
+    resp.close()
+
+    assert client.get('/stream?ids=nope').status_code == 404
+
+def test_stream_follows_shared_file(monkeypatch, tmp_path):
+
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    path = str(tmp_path / 'snapshot')
+    feeds = { url: make_feed([('t1', '1', 'NORTH', [('101N', now + 120)])], timestamp=now) }
+    producer = ReplayMtapi(feeds, expires_seconds=0, shared_file=path)
+    reader = Mtapi('./data/stations.json', shared_file=path, shared_role='reader')
+    monkeypatch.setattr(app, 'mta', reader)
+    monkeypatch.setitem(app.app.config, 'STREAM_POLL_SECONDS', 0.05)
+
+    # no other request reaches this worker, so the stream itself must
+    # notice the producer's new snapshot
+    resp = app.app.test_client().get('/stream?ids=101', buffered=False)
+    next(resp.response)
+    feeds[url] = make_feed([('t1', '1', 'NORTH', [('101N', now + 90)])], timestamp=now + 30)
+    producer._update()
+
+    event = next(resp.response)
+    assert event.startswith(b'data: ')
+    assert json.loads(event[6:])['data'][0]['N'][0]['time'] == producer.get_by_id(['101'])[0]['N'][0]['time'].isoformat()
+    resp.close()
+
+def test_etag_shared_by_readers(monkeypatch, tmp_path):
+    now = time.time()
+    path = str(tmp_path / 'snapshot')
+    feeds = { Mtapi._FEED_URLS[0]: make_feed([('t1', '1', 'NORTH', [('101N', now + 120)])], timestamp=now) }
+    producer = ReplayMtapi(feeds, expires_seconds=0, shared_file=path)
+
+    # every worker process follows the same producer, so a tag one of them
+    # handed out revalidates against any other
+    monkeypatch.setattr(app, 'mta', Mtapi('./data/stations.json', shared_file=path, shared_role='reader'))
+    etag = app.app.test_client().get('/by-id/101').headers['ETag']
+    monkeypatch.setattr(app, 'mta', Mtapi('./data/stations.json', shared_file=path, shared_role='reader'))
+    resp = app.app.test_client().get('/by-id/101', headers={'If-None-Match': etag})
+
+    assert resp.status_code == 304
+    assert etag.strip('"') == snapshot_etag(producer.snapshot(), None)
+
+def test_limit_params(client):
+    client, feeds = client
+    station = client.get('/by-id/101?max_trains=0').get_json()['data'][0]
+    assert station['N'] == [] and station['S'] == []
+
+    station = client.get('/by-id/101?max_minutes=1').get_json()['data'][0]
+    assert len(station['S']) == 0 and len(station['N']) == 0
+
+    station = client.get('/by-id/101?max_minutes=2&max_trains=50').get_json()['data'][0]
+    assert len(station['S']) == 1 and len(station['N']) == 1
+
+def test_metrics(client):
+    client, feeds = client
+    client.get('/by-id/101')
+    resp = client.get('/metrics')
+    text = resp.get_data(as_text=True)
+
+    assert resp.mimetype == 'text/plain'
+    assert 'mtapi_request_seconds_count{endpoint="by_index"} 1' in text
+    assert 'mtapi_feed_fetch_seconds_count{feed="gtfs"}' in text
+    assert '# TYPE mtapi_snapshot_build_seconds histogram' in text
+    assert 'mtapi_snapshot_version ' in text
+
+def test_batch(client):
+    client, feeds = client
+    resp = client.post('/batch', json={'queries': [
+        {'by': 'id', 'ids': ['101', '103']},
+        {'by': 'route', 'route': '1', 'max_trains': 1},
+        {'by': 'location', 'lat': 40.889248, 'lon': -73.898583},
+        {'by': 'id', 'ids': ['nope']}
+    ]})
+    results = resp.get_json()['results']
+
+    assert resp.status_code == 200
+    assert results[0] == client.get('/by-id/101,103').get_json()
+    assert results[1] == client.get('/by-route/1?max_trains=1').get_json()
+    assert results[2] == client.get('/by-location?lat=40.889248&lon=-73.898583').get_json()
+    assert results[3] == {'error': 'Station not found'}
+
+    assert client.post('/batch', json={'queries': [{'by': 'id'}]}).status_code == 400
+    for lat, lon in (('nan', -73.9), (1e308, 1e308)):
+        resp = client.post('/batch', json={'queries': [{'by': 'location', 'lat': lat, 'lon': lon}]})
+        assert resp.status_code == 400 and 'lat must be within' in resp.get_json()['error']
+    assert client.post('/batch', json=[]).status_code == 400
+    for limit in ('"max_trains": 1e400', '"max_minutes": Infinity'):
+        body = '{"queries": [{"by": "id", "ids": ["101"], %s}]}' % limit
+        assert client.post('/batch', data=body, content_type='application/json').status_code == 400
+
+def test_compression(client):
+    import gzip
+
+    client, feeds = client
+    plain = client.get('/by-location?lat=40.889248&lon=-73.898583')
+    resp = client.get('/by-location?lat=40.889248&lon=-73.898583', headers={'Accept-Encoding': 'gzip'})
+
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(resp.data) == plain.data
+    assert 'Content-Encoding' not in plain.headers
+    assert resp.headers['ETag'] != plain.headers['ETag']
+    assert client.get('/by-location?lat=40.889248&lon=-73.898583',
+                      headers={'If-None-Match': plain.headers['ETag'], 'Accept-Encoding': 'gzip'}).status_code == 200
+
+    # nearby points that find the same stations share one cached body
+    client.get('/by-location?lat=40.889&lon=-73.8986')
+    assert len(app.mta._snapshot._envelopes) == 1
+
+def test_by_trip(client):
+    client, feeds = client
+    resp = client.get('/by-trip/t2')
+    trip = resp.get_json()['data'][0]
+
+    assert resp.headers['ETag']
+    assert [ stop['id'] for stop in trip['stops'] ] == ['101', '103']
+
+    position = client.get('/by-trip/t2/position').get_json()['data'][0]
+    assert position['next']['id'] == '101'
+    assert client.get('/by-trip/nope').status_code == 404
+    assert client.get('/by-trip/nope/position').status_code == 404
+
+def test_history(client, monkeypatch, tmp_path):
+    client, feeds = client
+    assert client.get('/history/by-id/101?at=0').status_code == 404
+
+    monkeypatch.setattr(app, 'mta', ReplayMtapi(feeds, expires_seconds=0, archive_dir=str(tmp_path)))
+    at = int(time.time()) + 1
+    station = client.get('/history/by-id/101?at=%d' % at).get_json()['data'][0]
+    assert station['S'][0]['trip'] == 't2'
+
+    assert client.get('/history/by-route/1?at=%d' % at).get_json()['data'][0]['id'] == '101'
+    assert client.get('/history/by-route/1?at=0').status_code == 404
+    for at in ('soon', 'inf', '-inf', 'nan'):
+        assert client.get('/history/by-id/101?at=' + at).status_code == 400
+    assert client.get('/history/by-id/101?at=1e300').status_code == 200
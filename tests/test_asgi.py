@@ -0,0 +1,65 @@
+import asyncio, json, time
+import pytest
+import asgi
+from mtapi import Mtapi
+from benchmarks.fixtures import make_feed, ReplayMtapi
+
+
+@pytest.fixture
+def feeds(monkeypatch):
+    now = time.time()
+    feeds = { Mtapi._FEED_URLS[0]: make_feed([('t1', '1', 'NORTH', [('101N', now + 60)])], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0, autoupdate=False)
+    monkeypatch.setattr(asgi, 'mta', mta)
+    monkeypatch.setattr(asgi, '_start_refreshing', lambda: None)
+    asyncio.run(mta.update_async())
+
+    return feeds
+
+def request(path, query=b'', headers=()):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'path': path, 'query_string': query, 'headers': list(headers)}
+    asyncio.run(asgi.app(scope, receive, send))
+
+    start, body = messages
+    return start['status'], dict(start['headers']), body['body']
+
+def test_by_id(feeds):
+    status, headers, body = request('/by-id/101')
+
+    assert status == 200
+    assert json.loads(body)['data'][0]['N'][0]['route'] == '1'
+
+    status, _, body = request('/by-id/101', headers=[(b'if-none-match', headers[b'etag'])])
+    assert status == 304
+    assert body == b''
+
+    gzip_headers = request('/by-id/101', headers=[(b'accept-encoding', b'gzip')])[1]
+    assert gzip_headers[b'etag'] != headers[b'etag']
+
+def test_by_location_and_routes(feeds):
+    status, _, body = request('/by-location', b'lat=40.889248&lon=-73.898583')
+    assert json.loads(body)['data'][0]['id'] == '101'
+
+    assert request('/by-location')[0] == 400
+    assert request('/by-location', b'lat=inf&lon=-73.9')[0] == 400
+    assert request('/by-location', b'lat=1e308&lon=1e308')[0] == 400
+    assert request('/by-route/1')[0] == 200
+    assert request('/by-route/X')[0] == 404
+    assert json.loads(request('/routes')[2])['data'] == ['1']
+
+def test_by_trip(feeds):
+    status, _, body = request('/by-trip/t1')
+    assert status == 200
+    assert json.loads(body)['data'][0]['stops'][0]['id'] == '101'
+
+    status, _, body = request('/by-trip/t1/position')
+    assert json.loads(body)['data'][0]['next']['id'] == '101'
+    assert request('/by-trip/nope')[0] == 404
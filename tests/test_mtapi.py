@@ -1,4 +1,7 @@
+import time
+import pytest
 from mtapi import Mtapi
+from benchmarks.fixtures import make_feed, ReplayMtapi
 
 def test_init():
     from app import app
@@ -8,3 +11,627 @@ def test_init():
         max_minutes=app.config['MAX_MINUTES'],
         expires_seconds=app.config['CACHE_SECONDS'],
         threaded=app.config['THREADED'])
+
+def test_feeds_load_concurrently():
+    now = time.time()
+    def slow_feed():
+        time.sleep(0.3)
+        return make_feed([('t1', '1', 'NORTH', [('101N', now + 60)])])
+
+    feeds = { url: slow_feed for url in Mtapi._FEED_URLS }
+    started = time.time()
+    mta = ReplayMtapi(feeds)
+
+    assert time.time() - started < 1
+    assert mta.get_by_id(['101'])[0]['N'][0]['route'] == '1'
+
+def test_failed_feed_keeps_last_good_data():
+    url = Mtapi._FEED_URLS[0]
+    mta = ReplayMtapi({ url: make_feed([('t1', '1', 'SOUTH', [('101S', time.time() + 60)])]) },
+                        expires_seconds=0)
+
+    mta.feed_data[url] = None
+    mta._update()
+
+    assert len(mta.get_by_id(['101'])[0]['S']) == 1
+
+def test_update_deadline():
+    url = Mtapi._FEED_URLS[0]
+    def hung_feed():
+        time.sleep(1)
+        return make_feed([])
+
+    started = time.time()
+    ReplayMtapi({ url: hung_feed }, update_deadline=0.2)
+
+    assert time.time() - started < 0.8
+
+def test_unchanged_feed_is_skipped():
+    now = time.time()
+    one, g = Mtapi._FEED_URLS[0], Mtapi._FEED_URLS[-1]
+    feeds = {
+        one: make_feed([('t1', '1', 'NORTH', [('101N', now + 60)])], timestamp=now),
+        g: make_feed([('t2', 'G', 'NORTH', [('G22N', now + 60)])], timestamp=now)
+    }
+    mta = ReplayMtapi(feeds, expires_seconds=0)
+    van_cortlandt = mta._snapshot.stations['101']
+
+    extracted = []
+    extract = mta._extract_arrivals
+    mta._extract_arrivals = lambda *args: extracted.append(args) or extract(*args)
+
+    feeds[g] = make_feed([('t2', 'G', 'NORTH', [('G22N', now + 120)])], timestamp=now + 30)
+    mta._update()
+
+    assert len(extracted) == 1
+    assert mta._snapshot.stations['101'] is van_cortlandt
+    assert mta.get_by_route('G')[0]['N'][0]['time'].timestamp() == int(now + 120)
+
+def test_validators_wait_for_ingest():
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    now = time.time()
+    responses = [ (0, b'not a feed'), (1, make_feed([])),
+                  (0, make_feed([('t1', '1', 'SOUTH', [('101S', now + 60)])], timestamp=now)) ]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.headers.get('If-None-Match') == '"v"':
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            delay, body = responses.pop(0)
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('ETag', '"v"')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    class LocalMtapi(Mtapi):
+        _FEED_URLS = [ 'http://127.0.0.1:%d/feed%%2Fgtfs' % server.server_port ]
+
+    try:
+        # the first download doesn't parse and the second misses the
+        # deadline, so neither may be answered with a 304 later
+        mta = LocalMtapi('./data/stations.json', expires_seconds=0, update_deadline=0.5)
+        assert mta._feeds[0].etag is None
+        mta._update()
+        mta._feeds[0].pending.result()
+        assert mta._feeds[0].etag is None
+
+        mta._update()
+        assert mta._feeds[0].etag == '"v"'
+        assert mta.get_by_id(['101'])[0]['S'][0]['trip'] == 't1'
+    finally:
+        server.shutdown()
+
+def test_feed_intervals():
+    loads = []
+    url = Mtapi._FEED_URLS[0]
+    feeds = { url: lambda: loads.append(url) }
+    mta = ReplayMtapi(feeds, feed_intervals={ url: 3600 })
+
+    mta._update()
+
+    assert len(loads) == 1
+
+def test_feed_schedule():
+    from mtapi._mtapifeed import _MtapiFeed
+
+    feed = _MtapiFeed(Mtapi._FEED_URLS[0], interval=30)
+    feed.timestamp = 1000
+    feed.schedule(1010)
+    assert feed.next_refresh == 1000 + 30 + feed.PUBLISH_DELAY
+
+    # the expected publish was missed, so wait for the one after
+    feed.schedule(1040)
+    assert feed.next_refresh == 1000 + 60 + feed.PUBLISH_DELAY
+
+    feed.backoff(1100)
+    assert 1115 <= feed.next_refresh <= 1130
+    feed.backoff(1100)
+    assert 1130 <= feed.next_refresh <= 1160
+
+    feed.schedule(1100)
+    assert feed.failures == 0
+
+def test_scheduler(monkeypatch):
+    import threading
+    from mtapi._mtapischeduler import _MtapiScheduler
+
+    monkeypatch.setattr(_MtapiScheduler, 'MIN_DELAY', 0.01)
+    url = Mtapi._FEED_URLS[0]
+    loads = []
+    refreshed = threading.Event()
+
+    def load():
+        loads.append(threading.current_thread().name)
+        if len(loads) >= 3:
+            refreshed.set()
+
+    mta = ReplayMtapi({ url: load }, expires_seconds=0.05, threaded=True)
+    assert refreshed.wait(5)
+
+    mta.stop()
+    assert not mta.scheduler.is_alive()
+    count = len(loads)
+    time.sleep(0.2)
+    assert len(loads) == count
+
+def test_seconds_until_update_follows_feeds(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    mta = ReplayMtapi({}, expires_seconds=60, autoupdate=False, shared_file=path)
+    for feed in mta._feeds:
+        feed.next_refresh = time.time() + 5
+    assert 4 < mta.seconds_until_update() <= 5
+
+    # readers go by the schedule the updater wrote
+    mta._update()
+    reader = Mtapi('./data/stations.json', expires_seconds=60, shared_file=path, shared_role='reader')
+    next_refresh = min(feed.next_refresh for feed in mta._feeds)
+    assert abs(reader.seconds_until_update() - (next_refresh - time.time())) < 1
+
+def test_refresh_single_flight():
+    import threading
+
+    mta = ReplayMtapi({}, expires_seconds=0.05)
+    updates = []
+    release = threading.Event()
+    update = mta._update
+
+    def slow_update():
+        updates.append(threading.current_thread().name)
+        release.wait(5)
+        update()
+
+    mta._update = slow_update
+    time.sleep(0.1)
+
+    queries = [ threading.Thread(target=mta.version) for _ in range(10) ]
+    for query in queries:
+        query.start()
+    time.sleep(0.2)
+
+    assert len(updates) == 1
+    assert sum(query.is_alive() for query in queries) == 10
+    release.set()
+    for query in queries:
+        query.join()
+    assert len(updates) == 1
+
+    # within the stale window, only the refreshing query waits
+    release.clear()
+    mta._STALE_SECONDS = 60
+    time.sleep(0.1)
+    leader = threading.Thread(target=mta.version)
+    leader.start()
+    time.sleep(0.1)
+
+    started = time.time()
+    mta.version()
+    assert time.time() - started < 0.1
+    assert leader.is_alive()
+    release.set()
+    leader.join()
+    assert len(updates) == 2
+
+    # queries on fresh data don't take the lock
+    class Unlockable(object):
+        def __enter__(self):
+            raise AssertionError('lock taken')
+    mta._EXPIRES_SECONDS = 60
+    mta._flight_lock = Unlockable()
+    mta.version()
+
+def test_snapshot_swap():
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    feeds = { url: make_feed([('t1', '1', 'NORTH', [('101N', now + 60)])], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0)
+    snapshot = mta._snapshot
+
+    mta._update()
+    assert mta._snapshot.version == snapshot.version
+    assert mta._snapshot.stations is snapshot.stations
+    assert mta.last_update() > snapshot.last_update
+
+    feeds[url] = make_feed([('t1', '1', 'NORTH', [('101N', now + 120)])], timestamp=now + 30)
+    mta._update()
+
+    assert mta._snapshot.version > snapshot.version
+    assert snapshot.stations['101'].trains['N'].times[0] == int(now + 60)
+
+def test_route_line_order():
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    feeds = { url: make_feed([
+        ('t1', '1', 'SOUTH', [('101S', now + 60), ('103S', now + 120)]),
+        ('t2', '1', 'NORTH', [('104N', now + 60), ('103N', now + 120)]),
+        # 125 and A24 are both 59 St-Columbus Circle
+        ('t3', '1', 'SOUTH', [('104S', now + 30), ('125S', now + 60), ('A24S', now + 90)])
+    ], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0)
+
+    # line order, not name order (231 St, 238 St, 59 St, Van Cortlandt Park)
+    assert [ station['id'] for station in mta.get_by_route('1') ] == ['101', '103', '104', '125']
+
+def test_trip_index(tmp_path):
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    path = str(tmp_path / 'snapshot')
+    feeds = { url: make_feed([
+        ('t1', '1', 'SOUTH', [('101S', now - 30), ('103S', now + 60), ('104S', now + 120)]),
+        ('t2', '1', 'NORTH', [('104N', now + 60)])
+    ], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0, shared_file=path)
+
+    trip = mta.get_by_trip(['t1'])[0]
+    assert [ stop['id'] for stop in trip['stops'] ] == ['103', '104']
+    assert trip['route'] == '1' and trip['direction'] == 'S'
+    assert mta.get_by_id(['103'])[0]['S'][0]['trip'] == 't1'
+
+    position = mta.get_trip_positions(['t1'])[0]
+    assert position['previous'] is None
+    assert position['next']['id'] == '103'
+    assert mta._snapshot.trips['t1'].position(now + 90) == 1
+
+    reader = Mtapi('./data/stations.json', shared_file=path, shared_role='reader')
+    assert reader.get_envelope_by_trip(['t1', 't2']).body == mta.get_envelope_by_trip(['t1', 't2']).body
+
+def test_shared_snapshot(tmp_path):
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    path = str(tmp_path / 'snapshot')
+    feeds = { url: make_feed([('t1', '1', 'NORTH', [('103N', now + 60), ('101N', now + 120)])], timestamp=now) }
+
+    reader = Mtapi('./data/stations.json', shared_file=path, shared_role='reader')
+    assert reader.get_by_id(['101'])[0]['N'] == []
+
+    producer = ReplayMtapi(feeds, expires_seconds=0, shared_file=path)
+    assert reader.version() == producer.version()
+    assert reader.get_envelope_by_id(['101', '103']).body == producer.get_envelope_by_id(['101', '103']).body
+    assert reader.get_envelope_by_route('1').body == producer.get_envelope_by_route('1').body
+    assert reader.last_update() == producer.last_update()
+
+    subscription = reader.subscribe(['101'])
+    feeds[url] = make_feed([('t1', '1', 'NORTH', [('101N', now + 90)])], timestamp=now + 30)
+    producer._update()
+
+    assert reader.get_by_id(['101'])[0]['N'][0]['time'] == producer.get_by_id(['101'])[0]['N'][0]['time']
+    assert reader.version() == producer.version()
+    assert subscription.wait(0) == {'101'}
+
+    # a refresh that changes nothing doesn't rewrite the file
+    from mtapi._mtapishared import file_key, write_snapshot
+    key = file_key(path)
+    producer._update()
+    assert file_key(path) == key
+
+    # and a rewrite of the same version keeps the reader's decoded data
+    stations = reader.snapshot().stations
+    time.sleep(0.01)
+    write_snapshot(path, producer.snapshot().refreshed(producer.last_update()))
+    assert reader.snapshot().stations is stations
+
+def test_warm_start(tmp_path):
+    import threading
+
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    feeds = { url: make_feed([('t1', '1', 'NORTH', [('101N', now + 60)])], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0, state_dir=str(tmp_path))
+    expected = mta.get_envelope_by_id(['101', '103']).body
+
+    # the MTA is unreachable and slow after the restart
+    release = threading.Event()
+    restarted = ReplayMtapi({ url: lambda: release.wait(5) and False }, expires_seconds=0,
+                              state_dir=str(tmp_path))
+
+    assert restarted.restored
+    assert restarted.version() == mta.version()
+    assert restarted.get_envelope_by_id(['101', '103']).body == expected
+    assert restarted._snapshot.updated == mta._snapshot.updated
+    assert 'mtapi_snapshot_age_seconds ' in restarted.render_metrics()
+
+    release.set()
+    restarted._warmup.join()
+
+    # the failed feed keeps the data saved before the restart
+    assert restarted.version() > mta.version()
+    assert restarted.get_envelope_by_id(['101', '103']).body == expected
+
+def test_state_rewritten_only_on_change(tmp_path):
+    import datetime
+    from mtapi._mtapishared import file_key
+    from mtaproto.feedresponse import TZ
+
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    path = str(tmp_path / 'snapshot')
+    feeds = { url: make_feed([('t1', '1', 'NORTH', [('101N', now + 60)])], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0, state_dir=str(tmp_path))
+    ino, _, size = file_key(path)
+
+    # refreshes that change nothing only touch the file
+    later = datetime.datetime.fromtimestamp(now + 30, TZ)
+    mta._publish([], later)
+    key = file_key(path)
+    assert (key[0], key[2]) == (ino, size)
+    assert abs(key[1] / 1e9 - later.timestamp()) < 0.001
+
+    restarted = ReplayMtapi({}, expires_seconds=0, autoupdate=False, state_dir=str(tmp_path))
+    assert restarted.version() == mta.version()
+    assert abs((restarted.last_update() - later).total_seconds()) < 0.001
+
+def test_compact_json():
+    import json
+
+    now = time.time()
+    feeds = { Mtapi._FEED_URLS[0]: make_feed([('t1', '1', 'NORTH', [('101N', now + 60)])], timestamp=now) }
+    mta = ReplayMtapi(feeds)
+    compact = ReplayMtapi(feeds, compact_json=True)
+
+    body = compact.get_envelope_by_id(['101', '103']).body
+    assert b', ' not in body and b'": ' not in body
+    assert json.loads(body) == json.loads(mta.get_envelope_by_id(['101', '103']).body)
+    assert compact.get_envelope_by_id(['101', '103']) is compact.get_envelope_by_id(['101', '103'])
+
+def test_archive_history_and_replay(tmp_path):
+    import datetime
+    from mtaproto.feedresponse import TZ
+
+    now = int(time.time())
+    url = Mtapi._FEED_URLS[0]
+    feeds = { url: make_feed([('t1', '1', 'NORTH', [('103N', now + 60), ('101N', now + 120)])], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0, archive_dir=str(tmp_path), archive_segment_seconds=600)
+
+    later = now + 3600
+    feed = make_feed([('t2', '1', 'NORTH', [('101N', later + 60)])], timestamp=later)
+    mta._publish([(mta._feeds[0], feed)], datetime.datetime.fromtimestamp(later, TZ))
+
+    assert len(mta.archive.segments()) == 2
+    assert mta.get_history_by_id(['101'], now + 5)[0]['N'][0]['trip'] == 't1'
+    assert mta.get_history_by_id(['101'], later + 5)[0]['N'][0]['trip'] == 't2'
+    assert mta.get_history_by_id(['103'], later + 5)[0]['N'] == []
+    assert [ s['id'] for s in mta.get_history_by_route('1', now + 5) ] == ['101', '103']
+
+    replayed = ReplayMtapi({}, autoupdate=False)
+    snapshots = list(replayed.replay(0, later, archive=mta.archive))
+    assert len(snapshots) == 2
+    assert replayed.get_envelope_by_id(['101', '103']).body == mta.get_envelope_by_id(['101', '103']).body
+
+def test_schedule_fallback(tmp_path, monkeypatch):
+    import datetime
+    from mtaproto.feedresponse import TZ
+    from mtapi._mtapischedule import build_schedule, _MtapiSchedule
+
+    now = int(time.time())
+    today = datetime.datetime.now(TZ).date()
+    midnight = int(TZ.localize(datetime.datetime(today.year, today.month, today.day)).timestamp())
+    def gtfs_time(epoch):
+        seconds = epoch - midnight
+        return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+    files = {
+        'calendar.txt': 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n'
+                        'ALL,1,1,1,1,1,1,1,20000101,20991231\nNONE,1,1,1,1,1,1,1,20000101,20991231\n',
+        'calendar_dates.txt': 'service_id,date,exception_type\nNONE,%s,2\n' % today.strftime('%Y%m%d'),
+        'trips.txt': 'route_id,service_id,trip_id\n1,ALL,s1\n1,NONE,s2\n',
+        'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+                          's1,{0},{0},101S,1\ns1,{1},{1},103S,2\ns2,{0},{0},101S,1\n'.format(
+                              gtfs_time(now + 120), gtfs_time(now + 240))
+    }
+    for name, text in files.items():
+        (tmp_path / name).write_text(text)
+    path = str(tmp_path / 'schedule')
+    with open(path, 'wb') as f:
+        f.write(build_schedule(str(tmp_path)))
+
+    schedule = _MtapiSchedule(path)
+    assert list(schedule.arrivals('101', now, now + 600)) == [('1', 'S', now + 120, 's1')]
+    assert list(schedule.arrivals('101', now + 180, now + 600)) == []
+
+    url = Mtapi._FEED_URLS[0]
+    feeds = { url: None }
+    mta = ReplayMtapi(feeds, expires_seconds=0, schedule_file=path, schedule_after=0)
+    train = mta.get_by_id(['101'])[0]['S'][0]
+    assert train['scheduled'] and train['trip'] == 's1'
+    assert b'"scheduled": true' in mta.get_envelope_by_id(['103']).body
+
+    # only stations on the scheduled routes are rebuilt as their trains come
+    # into the time window
+    assert mta._snapshot.stations['104'].valid_until is None
+    mta._publish([], datetime.datetime.fromtimestamp(now + mta.SCHEDULE_REBUILD_SECONDS, TZ))
+    assert 'mtapi_snapshot_stations_rebuilt 2' in mta.render_metrics()
+
+    # the feed was down from the start, so only the schedule knows its routes
+    assert list(mta.get_routes()) == ['1']
+    assert sorted(station['id'] for station in mta.get_by_route('1')) == ['101', '103']
+    assert mta.get_by_route('1')[0]['S'][0]['scheduled']
+
+    import app
+    monkeypatch.setattr(app, 'mta', mta)
+    resp = app.app.test_client().get('/by-route/1')
+    assert resp.status_code == 200
+    assert sorted(station['id'] for station in resp.get_json()['data']) == ['101', '103']
+
+    # live data replaces the schedule once the feed recovers
+    feeds[url] = make_feed([('t1', '1', 'SOUTH', [('101S', now + 90)])], timestamp=now)
+    mta._feeds[0].next_refresh = 0
+    mta._update()
+    train = mta.get_by_id(['101'])[0]['S'][0]
+    assert train['trip'] == 't1' and 'scheduled' not in train
+    assert mta.get_by_id(['103'])[0]['S'] == []
+    assert mta.get_by_trip(['t1'])
+
+    # and once it fails again its old trips go with its old arrivals
+    feeds[url] = None
+    mta._feeds[0].next_refresh = 0
+    mta._update()
+    assert mta.get_by_id(['101'])[0]['S'][0]['scheduled']
+    with pytest.raises(KeyError):
+        mta.get_by_trip(['t1'])
+
+def test_station_catalog(tmp_path):
+    import json, subprocess, sys
+
+    files = {
+        'stops.txt': 'stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station\n'
+                     '101,Z Terminal,40.89,-73.90,1,\n101N,Z Terminal,40.89,-73.90,,101\n101S,Z Terminal,40.89,-73.90,,101\n'
+                     '103,M Street,40.88,-73.90,1,\n103N,M Street,40.88,-73.90,,103\n103S,M Street,40.88,-73.90,,103\n'
+                     '125,A Circle,40.768,-73.982,1,\n125N,A Circle,40.768,-73.982,,125\n125S,A Circle,40.768,-73.982,,125\n'
+                     'A24,A Circle,40.768,-73.981,1,\nX99,B Plaza,40.767,-73.981,1,\n',
+        # A24 links 125 and X99, which have no transfer of their own
+        'transfers.txt': 'from_stop_id,to_stop_id,transfer_type,min_transfer_time\n125,A24,2,180\nX99,A24,2,180\n',
+        'trips.txt': 'route_id,service_id,trip_id\n1,ALL,s1\n1,ALL,n1\n',
+        'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+                          's1,08:00:00,08:00:00,101S,1\ns1,08:02:00,08:02:00,103S,2\n'
+                          'n1,08:00:00,08:00:00,125N,1\nn1,08:09:00,08:09:00,103N,2\n'
+    }
+    for name, text in files.items():
+        (tmp_path / name).write_text(text)
+
+    script = 'scripts/make_stations.py'
+    subprocess.run([sys.executable, script, str(tmp_path), str(tmp_path)], check=True, stdout=subprocess.DEVNULL)
+    stations_file, catalog_file = str(tmp_path / 'stations.json'), str(tmp_path / 'stations.catalog')
+    with open(stations_file) as f:
+        stations = json.load(f)
+    assert sorted(stations) == ['101', '103', '125']
+    assert sorted(stations['125']['stops']) == ['125', 'A24', 'X99']
+    assert stations['125']['name'] == 'A Circle / B Plaza'
+
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    # no trip in the feed visits two of these stations, so only the
+    # catalog knows the line order
+    feeds = { url: make_feed([
+        ('t1', '1', 'SOUTH', [('125S', now + 60)]),
+        ('t2', '1', 'SOUTH', [('101S', now + 60)]),
+        ('t3', '1', 'SOUTH', [('103S', now + 60)])
+    ], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0, stations_file=stations_file, catalog_file=catalog_file)
+    assert mta._stops_to_stations['X99'] == '125'
+    assert [ station['id'] for station in mta.get_by_route('1') ] == ['101', '103', '125']
+    assert [ station['id'] for station in mta.get_by_point((40.767, -73.981), 1) ] == ['125']
+
+    # a catalog built from another stations file is ignored
+    stations['125']['name'] = 'Circle'
+    with open(stations_file, 'w') as f:
+        json.dump(stations, f)
+    mta = ReplayMtapi(feeds, expires_seconds=0, stations_file=stations_file, catalog_file=catalog_file)
+    assert [ station['id'] for station in mta.get_by_route('1') ] == ['125', '103', '101']
+
+def test_spatial_index_matches_linear_scan():
+    import json, random
+    from mtapi._spatialindex import _SpatialIndex, distance
+
+    with open('./data/stations.json') as f:
+        stations = json.load(f)
+    index = _SpatialIndex((id, s['location']) for id, s in stations.items())
+
+    rng = random.Random(1)
+    for _ in range(200):
+        point = (rng.uniform(40.5, 40.95), rng.uniform(-74.3, -73.7))
+        expected = sorted(stations, key=lambda id: distance(stations[id]['location'], point))[:5]
+        assert [ id for _, id in index.nearest(point, 5) ] == expected
+
+    assert len(index.nearest((0, 0), 1)) == 1
+    assert all(d <= 400 for d, _ in index.nearest((40.7527, -73.9772), 10, radius=400))
+
+def test_subscription_receives_changed_stations():
+    now = time.time()
+    url = Mtapi._FEED_URLS[0]
+    feeds = { url: make_feed([('t1', '1', 'NORTH', [('101N', now + 60), ('103N', now + 60)])], timestamp=now) }
+    mta = ReplayMtapi(feeds, expires_seconds=0)
+
+    subscription = mta.subscribe(['101'])
+    feeds[url] = make_feed([('t1', '1', 'NORTH', [('101N', now + 60), ('103N', now + 90)])], timestamp=now + 30)
+    mta._update()
+    assert subscription.wait(0) == set()
+
+    feeds[url] = make_feed([('t1', '1', 'NORTH', [('101N', now + 90), ('103N', now + 90)])], timestamp=now + 60)
+    mta._update()
+    assert subscription.wait(0) == {'101'}
+
+    rendered = mta.get_json_by_subscription(subscription, {'101'})
+    assert b'"id": "101"' in rendered[0][0]
+    subscription.close()
+
+def test_station_keeps_earliest_trains():
+    now = time.time()
+    trips = [ ('t%d' % i, '1', 'NORTH', [('101N', now + 600 - i * 10)]) for i in range(50) ]
+    mta = ReplayMtapi({ Mtapi._FEED_URLS[0]: make_feed(trips, timestamp=now) }, max_trains=3)
+
+    times = mta._snapshot.stations['101'].trains['N'].times
+    assert list(times) == [ int(now + 600 - i * 10) for i in (49, 48, 47) ]
+
+def test_load_config(monkeypatch, tmp_path):
+    from mtapi._mtapiconfig import DEFAULTS, load_config, mtapi_options
+
+    path = tmp_path / 'settings.cfg'
+    path.write_text("STATIONS_FILE = './data/stations.json'\nCACHE_SECONDS = 30\nlowercase = 1\n")
+    monkeypatch.setenv('MTAPI_SETTINGS', str(path))
+    config = load_config()
+
+    assert config['CACHE_SECONDS'] == 30
+    assert config['STALE_SECONDS'] == DEFAULTS['STALE_SECONDS']
+    assert 'lowercase' not in config
+    assert mtapi_options(config)['expires_seconds'] == 30
+
+def test_file_helpers(monkeypatch):
+    import struct
+    from array import array
+    from mtapi import _mtapifile
+    from mtapi._mtapifile import StringTable, decode_strings, array_bytes, read_array
+
+    strings = StringTable()
+    assert [ strings.ref(value) for value in ('', 'a', '', 'b') ] == [0, 1, 0, 2]
+    assert decode_strings(strings.encode()) == ['', 'a', 'b']
+    assert decode_strings(StringTable().encode()) == []
+
+    # little-endian whatever the host
+    values = array('I', [1, 2 ** 24])
+    assert array_bytes(values) == struct.pack('<II', 1, 2 ** 24)
+    monkeypatch.setattr(_mtapifile, '_SWAP', True)
+    assert read_array('I', array_bytes(values)) == values
+
+def test_feed_stop_times():
+    from mtaproto.feedresponse import FeedResponse, nyct_subway_pb2
+
+    feed = nyct_subway_pb2.gtfs__realtime__pb2.FeedMessage()
+    feed.ParseFromString(make_feed([
+        ('t1', 'GS', 'SOUTH', [('902S', 100), ('901S', 200)]),
+        ('t2', '6X', 'NORTH', [('621N', 150)])
+    ]))
+    feed.entity.add(id='vehicle').vehicle.trip.trip_id = 't1'
+
+    mta_data = FeedResponse(feed.SerializeToString())
+    assert mta_data.stop_times(120) == [('t1', 'S', 'S', '901', 200), ('t2', '6X', 'N', '621', 150)]
+
+def test_benchmark_smoke():
+    from benchmarks.bench import run, compare
+    from benchmarks.fixtures import synthetic_feeds
+
+    results = run(lambda scale: synthetic_feeds(scale=scale), [0.1], 1, 5, 2)
+    metrics = results['scale=0.1']
+
+    assert metrics['update_ms'] > 0
+    assert 'envelope_by_route_per_s' in metrics
+    assert compare(results, results, 0) == []
+
+def test_stress_smoke():
+    from benchmarks.stress import stress
+    from benchmarks.fixtures import synthetic_feeds
+
+    result = stress(synthetic_feeds(scale=0.1), 2, 0.5)
+
+    assert result['reads_per_s'] > 0
+    assert result['snapshots'] > 1
@@ -0,0 +1,38 @@
+# coding: utf-8
+"""
+    mta-api-sanity updater
+    ~~~~~~
+
+    Refreshes the MTA feeds in a single process and writes every snapshot to
+    SHARED_FILE. When SHARED_FILE is set, app.py and asgi.py workers read
+    snapshots from that file instead of polling the MTA themselves, so adding
+    workers doesn't add upstream traffic.
+
+    :copyright: (c) 2014 by Jon Thornton.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from mtapi.mtapi import Mtapi
+from mtapi._mtapischeduler import _MtapiScheduler
+from mtapi._mtapiconfig import load_config, mtapi_options
+import logging
+
+config = load_config()
+
+if not config['SHARED_FILE']:
+    raise Exception('SHARED_FILE must be set to run the updater.')
+
+if config['DEBUG']:
+    logging.basicConfig(level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+
+def main():
+    mta = Mtapi(config['STATIONS_FILE'], shared_role='producer', autoupdate=False, **mtapi_options(config))
+
+    # every feed starts out due, so the first pass is the initial refresh
+    _MtapiScheduler(mta, config['CACHE_SECONDS']).run()
+
+
+if __name__ == '__main__':
+    main()